@@ -0,0 +1,332 @@
+#  Micro-benchmarks for the loader, mixer and recorder hot paths, run on synthetic WAV files.
+#  Needs numpy and the compiled samplerbox_audio module, but no Raspberry Pi hardware.
+#
+#  python3 benchmark.py                              run, print and save the results to benchmark.json
+#  python3 benchmark.py --baseline old.json          also exit with 1 if a hot path is slower than in old.json
+#                                                    by more than --threshold (default 20%)
+#
+#  Before timing, the fixed-point mixer is checked bit for bit against a pure Python model of its
+#  arithmetic; the run exits with 1 on any mismatch.
+
+import argparse
+import json
+import os
+import platform
+import struct
+import sys
+import tempfile
+import time
+import numpy
+import samplerbox
+import samplerbox_audio
+
+samplerbox.LOG_FILE = os.devnull
+samplerbox.USE_SAMPLE_CACHE = False
+
+FORMATS = [(2, 1), (2, 2), (3, 1), (3, 2)]      # (sample width, channels)
+VOICES = [1, 4, 13, 32]
+BLOCKSIZE = 512
+
+#########################################
+# SYNTHETIC WAV FIXTURES
+#
+#########################################
+
+def WriteWav(filename, nframes, sampwidth=2, nchannels=1, loop=None, freq=65.41, samplerate=44100):
+    # Decaying sine (C2 by default), with a smpl chunk when loop=(start, end) is given
+    t = numpy.arange(nframes)
+    signal = numpy.sin(2 * numpy.pi * freq * t / samplerate) * numpy.exp(-t / (2.0 * samplerate)) * 0.5
+    signal = numpy.repeat(signal, nchannels)
+    if sampwidth == 2:
+        data = (signal * 32767).astype('<i2').tobytes()
+    else:
+        ints = (signal * 8388607).astype('<i4').tobytes()
+        data = b''.join(ints[i:i + 3] for i in range(0, len(ints), 4))
+    chunks = struct.pack('<4sIHHIIHH', b'fmt ', 16, 1, nchannels, samplerate, samplerate * nchannels * sampwidth, nchannels * sampwidth, 8 * sampwidth)
+    if loop:
+        chunks += struct.pack('<4sIiiiiiiiii', b'smpl', 36 + 24, 0, 0, 0, 60, 0, 0, 0, 1, 0)
+        chunks += struct.pack('<iiiiii', 0, 0, loop[0], loop[1], 0, 0)
+    chunks += struct.pack('<4sI', b'data', len(data)) + data
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<4sI4s', b'RIFF', 4 + len(chunks), b'WAVE') + chunks)
+
+def FormatName(sampwidth, nchannels):
+    return '%dbit-%s' % (8 * sampwidth, 'mono' if nchannels == 1 else 'stereo')
+
+def MakeFixtures(directory, seconds=2.0):
+    nframes = int(seconds * 44100)
+    fixtures = {}
+    for sampwidth, nchannels in FORMATS:
+        for looped in (False, True):
+            name = FormatName(sampwidth, nchannels) + ('-looped' if looped else '')
+            filename = os.path.join(directory, name + '.wav')
+            WriteWav(filename, nframes, sampwidth, nchannels, (nframes // 2, nframes - 10) if looped else None)
+            fixtures[name] = filename
+    return fixtures
+
+#########################################
+# TIMING
+#
+#########################################
+
+def Measure(fn, mintime=0.2, repeat=5):
+    # Best time of one call, over repeat runs of a batch of calls lasting about mintime / repeat
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        if time.perf_counter() - start > mintime / repeat:
+            break
+        number *= 2
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = (time.perf_counter() - start) / number
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+results = {}
+
+def Record(name, seconds, **extra):
+    results[name] = dict(seconds=seconds, **extra)
+    details = ', '.join('%s %.3g' % (k, v) for k, v in extra.items())
+    print('%-48s %12.2f us  %s' % (name, seconds * 1e6, details))
+
+#########################################
+# LOADER
+#
+#########################################
+
+def BenchLoader(fixtures):
+    for name, filename in sorted(fixtures.items()):
+        size = os.path.getsize(filename)
+        Record('waveread/' + name, Measure(lambda: samplerbox.waveread(filename).close()))
+        seconds = Measure(lambda: samplerbox.Sound(filename, 36, 127, 0))
+        Record('Sound/' + name, seconds, mbps=size / 1e6 / seconds)
+
+    for sampwidth, nchannels in FORMATS:
+        name = FormatName(sampwidth, nchannels)
+        wf = samplerbox.waveread(fixtures[name])
+        data = wf.readframes(wf.getnframes())
+        wf.close()
+        seconds = Measure(lambda: samplerbox.Sound.frames2array(None, data, sampwidth, nchannels))
+        Record('frames2array/' + name, seconds, mbps=len(data) / 1e6 / seconds)
+        if sampwidth == 3:
+            seconds = Measure(lambda: samplerbox_audio.binary24_to_int16(data, len(data) // 3))
+            Record('binary24_to_int16/' + name, seconds, mbps=len(data) / 1e6 / seconds)
+
+    sound = samplerbox.Sound(fixtures['16bit-mono'], 36, 127, 0)
+    def Fill():
+        samplerbox.FillSampleMap({(note, 127): sound for note in range(36, 49)})
+    Record('FillSampleMap/13-samples', Measure(Fill))
+
+#########################################
+# MIXER
+#
+#########################################
+
+def Mix(voices, interpolate=True):
+    rmlist = []
+    return samplerbox_audio.mixaudiobuffers(voices, rmlist, BLOCKSIZE, samplerbox.FADEOUT, samplerbox.FADEOUTLENGTH, interpolate)
+
+def MixFixed(voices, interpolate=True, volume=32768):
+    rmlist = []
+    return samplerbox_audio.mixaudiobuffers_fixed(voices, rmlist, BLOCKSIZE, samplerbox.FADEOUT_Q15, samplerbox.FADEOUTLENGTH, interpolate, volume)
+
+def MakeVoices(sound, count, transpose=0, state='plain'):
+    voices = []
+    for i in range(count):
+        snd = samplerbox.PlayingSound(sound, sound.midinote + transpose)
+        if state == 'fadeout':
+            snd.isfadeout = True
+        elif state == 'crossfade':
+            snd.crossfade()
+        elif state == 'bend':
+            snd.bend(200)
+        voices.append(snd)
+    return voices
+
+def Rewind(voices):
+    for snd in voices:
+        snd.pos = 0
+        snd.fadeoutpos = 0
+        snd.speed = samplerbox.PitchToSpeed(snd.cents)
+
+def ReferenceMixFixed(voices, frame_count, interpolate=True, volume=32768):
+    # Same integer arithmetic as mixaudiobuffers_fixed, one sample at a time, updates the voices the same way
+    fadeout = samplerbox.FADEOUT_Q15
+    acc = [0] * (2 * frame_count)
+    for snd in voices:
+        k = int(snd.pos)
+        frac = int((snd.pos - k) * 65536)
+        inc = int(snd.speed * 65536 + 0.5) << 16
+        dinc = ((int(snd.targetspeed * 65536 + 0.5) << 16) - inc) // frame_count
+        gain = int(snd.gain * 32768)
+        looppos = snd.sound.loop
+        length = snd.sound.nframes
+        zz = snd.sound.data.reshape(-1).tolist()
+        g = gain
+        i = 0
+        for i in range(frame_count):
+            if k > length - 4 and looppos == -1:
+                break
+            if k > length - 2:
+                k = looppos + 1
+                frac = 0
+            if snd.isfadeout:
+                f = min(snd.fadeoutpos + i * snd.fadeoutstep, samplerbox.FADEOUTLENGTH)
+                g = (int(fadeout[f]) * gain) >> 15
+            frac15 = frac >> 1
+            if snd.sound.numchan == 1:
+                s0 = s1 = zz[k] + (((zz[k + 1] - zz[k]) * frac15) >> 15) if interpolate else zz[k]
+            elif interpolate:
+                s0 = zz[2 * k] + (((zz[2 * k + 2] - zz[2 * k]) * frac15) >> 15)
+                s1 = zz[2 * k + 1] + (((zz[2 * k + 3] - zz[2 * k + 1]) * frac15) >> 15)
+            else:
+                s0 = zz[2 * k]
+                s1 = zz[2 * k + 1]
+            acc[2 * i] += (s0 * g) >> 15
+            acc[2 * i + 1] += (s1 * g) >> 15
+            frac += inc >> 16
+            k += frac >> 16
+            frac &= 0xFFFF
+            inc += dinc
+        if snd.isfadeout:
+            snd.fadeoutpos += i * snd.fadeoutstep
+        snd.pos = k + frac / 65536.0
+        snd.speed = snd.targetspeed
+    return numpy.clip((numpy.array(acc, numpy.int64) * volume) >> 15, -32768, 32767).astype(numpy.int16)
+
+def VerifyFixed(fixtures):
+    # Three consecutive blocks per case, so that loop wraps and fade positions carry over between calls
+    cases = [
+        ('16bit-mono', 0, 'plain', 1.0, True, 32768),
+        ('16bit-mono', 7, 'plain', 1.0, True, 32768),
+        ('16bit-mono', -5, 'plain', 0.7, True, 20000),
+        ('16bit-mono', 0, 'bend', 1.0, True, 32768),
+        ('16bit-mono', -12, 'bend', 1.0, False, 32768),
+        ('16bit-mono-looped', 12, 'plain', 1.0, True, 32768),
+        ('16bit-stereo', 3, 'plain', 0.5, True, 32768),
+        ('16bit-mono', 0, 'fadeout', 1.0, True, 32768),
+        ('16bit-mono', 2, 'crossfade', 0.8, True, 32768),
+        ('16bit-mono', 5, 'plain', 1.0, False, 65536),
+    ]
+    failures = 0
+    for fixture, transpose, state, gain, interpolate, volume in cases:
+        sound = samplerbox.Sound(fixtures[fixture], 48, 127, 1)
+        voices = MakeVoices(sound, 4, transpose, state)
+        models = MakeVoices(sound, 4, transpose, state)
+        for n, (snd, model) in enumerate(zip(voices, models)):
+            snd.gain = model.gain = gain
+            snd.pos = model.pos = n * 1000.25 + (sound.nframes - 5000 if fixture.endswith('looped') else 0)
+        for block in range(3):
+            got = MixFixed(voices, interpolate, volume)
+            expected = ReferenceMixFixed(models, BLOCKSIZE, interpolate, volume)
+            positions = [(snd.pos, snd.fadeoutpos, snd.speed) for snd in voices] == [(snd.pos, snd.fadeoutpos, snd.speed) for snd in models]
+            if not numpy.array_equal(got, expected) or not positions:
+                failures += 1
+                print('MISMATCH mixaudiobuffers_fixed/%s/%+d/%s block %d: %d samples differ%s' % (
+                    fixture, transpose, state, block, numpy.count_nonzero(got != expected), '' if positions else ', positions differ'))
+    print('mixaudiobuffers_fixed: %d cases %s' % (len(cases), 'bit-exact' if not failures else 'FAILED'))
+    return not failures
+
+def BenchMixer(fixtures):
+    cases = [
+        ('16bit-mono', 0, 'plain', True),
+        ('16bit-mono', 7, 'plain', True),
+        ('16bit-mono', 12, 'plain', True),
+        ('16bit-mono', -5, 'plain', True),
+        ('16bit-mono', 0, 'bend', True),
+        ('16bit-mono-looped', 0, 'plain', True),
+        ('16bit-stereo', 0, 'plain', True),
+        ('16bit-mono', 0, 'fadeout', True),
+        ('16bit-mono', 0, 'crossfade', True),
+        ('16bit-mono', 0, 'plain', False),
+    ]
+    blocktime = BLOCKSIZE / 44100.0
+    for fixture, transpose, state, interpolate in cases:
+        sound = samplerbox.Sound(fixtures[fixture], 36, 127, 1)
+        for count in VOICES:
+            voices = MakeVoices(sound, count, transpose, state)
+            def Block():
+                Rewind(voices)
+                Mix(voices, interpolate)
+            seconds = Measure(Block)
+            name = 'mixaudiobuffers/%s/%+d/%s%s/%dv' % (fixture, transpose, state, '' if interpolate else '-nointerp', count)
+            Record(name, seconds, us_per_voice=seconds * 1e6 / count, realtime=blocktime / seconds)
+            def BlockFixed():
+                Rewind(voices)
+                MixFixed(voices, interpolate)
+            seconds = Measure(BlockFixed)
+            Record(name.replace('mixaudiobuffers/', 'mixaudiobuffers_fixed/'), seconds, us_per_voice=seconds * 1e6 / count, realtime=blocktime / seconds)
+
+#########################################
+# RECORDER
+#
+#########################################
+
+def BenchRecorder():
+    # What recording adds to the audio callback, against a plain copy of the block
+    block = numpy.ones((BLOCKSIZE, 2), numpy.int16)
+    copy = numpy.empty_like(block)
+    Record('copy/%d-frames' % BLOCKSIZE, Measure(lambda: numpy.copyto(copy, block)))
+    recorder = samplerbox.Recorder()
+    Record('Recorder.push/idle', Measure(lambda: recorder.push(block)))
+    recorder.prepare()
+    recorder.active = True
+    def Push():
+        recorder.readpos = recorder.writepos        # an instant writer, the ring never fills
+        recorder.push(block)
+    Record('Recorder.push/recording', Measure(Push))
+    def PushWrap():
+        recorder.writepos = recorder.readpos = recorder.size - BLOCKSIZE // 2
+        recorder.push(block)
+    Record('Recorder.push/wrap', Measure(PushWrap))
+    recorder.readpos = 0
+    recorder.writepos = recorder.size
+    Record('Recorder.push/overflow', Measure(lambda: recorder.push(block)))
+    recorder.active = False
+
+#########################################
+# RESULTS
+#
+#########################################
+
+def Compare(baseline, threshold):
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name in baseline:
+            ratio = result['seconds'] / baseline[name]['seconds']
+            if ratio > 1 + threshold:
+                regressions.append((name, ratio))
+    for name, ratio in regressions:
+        print('REGRESSION %-48s %+.0f%%' % (name, (ratio - 1) * 100))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SamplerBox loader, mixer and recorder micro-benchmarks')
+    parser.add_argument('--output', default='benchmark.json', help='where to save the results')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        fixtures = MakeFixtures(directory)
+        if not VerifyFixed(fixtures):
+            sys.exit(1)
+        BenchLoader(fixtures)
+        BenchMixer(fixtures)
+        BenchRecorder()
+
+    with open(args.output, 'w') as f:
+        json.dump({'machine': platform.machine(), 'python': platform.python_version(), 'numpy': numpy.__version__,
+                   'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=1, sort_keys=True)
+    print('Saved to ' + args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if Compare(json.load(f)['results'], args.threshold):
+                sys.exit(1)
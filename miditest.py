@@ -0,0 +1,32 @@
+#  Prints the MIDI messages that samplerbox.py would receive.
+#
+#  python3 miditest.py                     feeds a test stream through a pty stand-in for the serial port
+#  python3 miditest.py /dev/ttyAMA0        reads the serial MIDI port
+#  python3 miditest.py /dev/snd/midiC1D0   reads an ALSA rawmidi device
+
+import os
+import sys
+import time
+import samplerbox
+
+def PrintMessage(message, event_time):
+    print('%.3f  %02X %3d %3d' % (event_time, message[0], message[1], message[2]))
+
+samplerbox.MidiCallback = PrintMessage
+
+if len(sys.argv) > 1 and sys.argv[1].startswith('/dev/snd/'):
+    samplerbox.StartRawMidi(sys.argv[1])
+elif len(sys.argv) > 1:
+    samplerbox.StartSerialMidi(sys.argv[1])
+else:
+    master, slave = os.openpty()
+    samplerbox.StartSerialMidi(os.ttyname(slave))
+    # note on C2, running status note on E2 with a clock byte in between,
+    # sustain on/off, note offs as note on with velocity 0, all notes off
+    os.write(master, bytes([0x90, 36, 100, 40, 0xF8, 90, 0xB0, 64, 127, 64, 0, 0x90, 36, 0, 40, 0, 0xB0, 123, 0]))
+
+try:
+    while True:
+        time.sleep(0.5)
+except KeyboardInterrupt:
+    print("Keyboard interrupt")
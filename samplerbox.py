@@ -15,57 +15,144 @@
 #########################################
 
 from contextlib import redirect_stdout
+import time
+import os
+
+BOOT_START = time.time()
+
+LOG_FILE = os.environ.get('SAMPLERBOX_LOG', '/home/pi/sbox.log')
 
 def writeToLog(string):
-    with open('/home/pi/sbox.log', 'a') as f:
+    with open(LOG_FILE, 'a') as f:
         with redirect_stdout(f):
             print(string)
 
-from datetime import datetime
-
-now = datetime.now()
-
-current_time = now.strftime("%d/%m/%Y %H:%M:%S")
-writeToLog("Starting samplerbox.py at " + str(current_time))
-
 AUDIO_DEVICE_ID = 0                    # change this number to use another soundcard
-SAMPLES_DIR = "/home/pi/samples/"   # The root directory containing the sample-sets. Example: "/media/" to look for samples on a USB stick / SD card
+SAMPLERATE = 44100
+BLOCKSIZE = 512
+SAMPLES_DIR = os.environ.get('SAMPLERBOX_SAMPLES', "/home/pi/samples/")   # The root directory containing the sample-sets. Example: "/media/" to look for samples on a USB stick / SD card
+CACHE_DIR = os.environ.get('SAMPLERBOX_CACHE', "/home/pi/.samplerbox-cache/")   # Decoded samples are cached here so that presets load faster on the next boot
+USE_SAMPLE_CACHE = True                 # Set to False to always decode and analyse the WAV files
+LIBRARY_POLL_SECS = 2                   # SAMPLES_DIR is checked this often for new media and presets (inotify reports changes inside it at once)
+TRIM_SILENCE = True                     # Skip the near-silence at the start of each sample, it adds to the pedal latency
+ONSET_THRESHOLD_DB = -40                # A sample starts where it first gets louder than this, relative to its peak
+NORMALIZE_SAMPLES = False               # Set to True to play every sample at the same peak level (NORMALIZE_PEAK_DB)
+NORMALIZE_PEAK_DB = -1
+AUTO_LOOP = False                       # Set to True to find zero-crossing loop points for mode 1 samples without a smpl chunk
 USE_SERIALPORT_MIDI = False             # Set to True to enable MIDI IN via SerialPort (e.g. RaspberryPi's GPIO UART pins)
+SERIALPORT_MIDI_DEVICE = '/dev/ttyAMA0'
+SERIALPORT_MIDI_BAUDRATE = 38400        # 38400 with the usual UART clock trick for 31250 baud MIDI
+USE_RAWMIDI = False                     # Set to True to enable MIDI IN via an ALSA rawmidi device (USB MIDI, or a snd-virmidi virtual port)
+RAWMIDI_DEVICE = '/dev/snd/midiC1D0'
+MIDI_CHANNEL = None                     # None listens on all channels, 0-15 listens on a single channel
+PITCHBEND_RANGE = 2                     # Semitones up or down at full MIDI pitch bend
 USE_I2C_7SEGMENTDISPLAY = True          # Set to True to use a 7-segment display via I2C
 USE_BUTTONS = True                     # Set to True to use momentary buttons (connected to RaspberryPi's GPIO pins) to change preset
 MAX_POLYPHONY = 13                      # This can be set higher, but 80 is a safe value
+FIXED_POINT_MIXER = False               # Set to True on a Pi Zero or Pi 1: integer mixing kernel, no floating point per sample
 DEBOUNCE_SECS = 0.15
-
-#########################################
-# 7-SEGMENT DISPLAY
-#
-#########################################
-
-# 7-Segment display using TM1637
-
-import tm1637
-
-display = tm1637.TM1637(CLK=10, DIO=9, brightness=1.0)
-display.Clear()
-digits = [0x00, 0x01, 0x02, 0x03]
-display.SetBrightness(1)
+USE_SIMULATED_HARDWARE = os.environ.get('SAMPLERBOX_SIMULATE') == '1'   # Use simhw.py instead of the GPIO, Numato, display and sound card
+CROSSFADE_SECS = 0.02                   # Short fade used for the mono handover and when voices are stolen
+MONO_MAX_TAILS = 1                      # Presets with "mono=1" let at most this many released notes ring out under the current one
+GOVERNOR_HIGH_LOAD = 0.8                # Quality steps down when a block takes more than this fraction of its duration to render (or underflows)
+GOVERNOR_LOW_LOAD = 0.4                 # and steps back up after GOVERNOR_RECOVER_BLOCKS blocks below this fraction
+GOVERNOR_RECOVER_BLOCKS = 200
+GOVERNOR_HOLD_BLOCKS = 20               # Blocks to wait after a step down before stepping down again
+GOVERNOR_TAILSTEP = 4                   # Release tails play this many times faster from quality level 1
+PERFORMANCE_MODE = False                # Set to True for real-time audio scheduling, CPU pinning and locked, pre-faulted sample memory
+AUDIO_RT_PRIORITY = 70                  # SCHED_FIFO priority of the audio thread
+AUDIO_CPUS = {3}                        # CPUs for the audio thread
+OTHER_CPUS = {0, 1, 2}                  # CPUs for everything else (buttons, MIDI, loader)
+RECORD_DIR = os.environ.get('SAMPLERBOX_RECORDINGS', '/home/pi/recordings/')   # Hold the panic switch for RECORD_HOLD_SECS to start or stop recording the output here
+RECORD_HOLD_SECS = 2
+RECORD_FORMAT = 'wav'                   # or 'flac', needs the soundfile module
+RECORD_BUFFER_SECS = 10                 # Output the recorder can hold while the SD card is busy
 
 #########################################
 # IMPORT
 # MODULES
 #########################################
 
+# Hardware modules (sounddevice, RPi.GPIO, tm1637, numato_gpio) are imported
+# by the boot stages below, so that a slow device does not hold up the others.
+
 import wave
-import time
 import numpy
-import os
 import re
-import sounddevice
+import hashlib
 import threading
 from chunk import Chunk
 import struct
+import json
+import ctypes
+import collections
+import select
 import samplerbox_audio
-import RPi.GPIO as GPIO
+
+#########################################
+# BOOT PROFILER
+#
+#########################################
+
+boottimes = []
+
+def Uptime():
+    try:
+        with open('/proc/uptime') as f:
+            return float(f.read().split()[0])
+    except (OSError, ValueError):
+        return None
+
+class BootStage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.time()
+        boottimes.append((self.name, self.start - BOOT_START, end - self.start))
+        if exc[0] is not None:
+            writeToLog('Boot: %s FAILED after %d ms' % (self.name, (end - self.start) * 1000))
+        else:
+            writeToLog('Boot: %s took %d ms (done at %d ms)' % (self.name, (end - self.start) * 1000, (end - BOOT_START) * 1000))
+
+#########################################
+# 7-SEGMENT DISPLAY
+#
+#########################################
+
+class PendingDisplay:
+    # Stands in for the TM1637 until it is initialised, and remembers the last message
+
+    def __init__(self):
+        self.message = None
+
+    def print7seg(self, message):
+        self.message = message
+
+display = PendingDisplay()
+
+def StartDisplay():
+    global display
+    try:
+        with BootStage('display'):
+            # 7-Segment display using TM1637
+            if USE_SIMULATED_HARDWARE:
+                from simhw import NullDisplay as TM1637
+            else:
+                from tm1637 import TM1637
+            tmdisplay = TM1637(CLK=10, DIO=9, brightness=1.0)
+            tmdisplay.Clear()
+            tmdisplay.SetBrightness(1)
+            pending, display = display, tmdisplay
+            if pending.message:
+                display.print7seg(pending.message)
+    except BaseException as e:
+        writeToLog('Failed in StartDisplay(): ' + str(e))     # boot goes on without the display
 
 #########################################
 # SLIGHT MODIFICATION OF PYTHON'S WAVE MODULE
@@ -79,6 +166,7 @@ class waveread(wave.Wave_read):
         self._soundpos = 0
         self._cue = []
         self._loops = []
+        self._pitchfraction = 0.0
         self._ieee = False
         self._file = Chunk(file, bigendian=0)
         if self._file.getname() != b'RIFF':
@@ -111,6 +199,7 @@ class waveread(wave.Wave_read):
             elif chunkname == b'smpl':
                 manuf, prod, sampleperiod, midiunitynote, midipitchfraction, smptefmt, smpteoffs, numsampleloops, samplerdata = struct.unpack(
                     b'<iiiiiiiii', chunk.read(36))
+                self._pitchfraction = (midipitchfraction & 0xFFFFFFFF) * 100.0 / 2 ** 32     # cents above the unity note
                 for i in range(numsampleloops):
                     cuepointid, type, start, end, fraction, playcount = struct.unpack(b'<iiiiii', chunk.read(24))
                     self._loops.append([start, end])
@@ -124,6 +213,100 @@ class waveread(wave.Wave_read):
     def getloops(self):
         return self._loops
 
+    def getpitchfraction(self):
+        return self._pitchfraction
+
+
+#########################################
+# DECODED SAMPLE CACHE
+#
+#########################################
+
+def CacheKey(filename):
+    # Taken once before the file is read: a file still being copied is cached under the key of what was read
+    st = os.stat(filename)
+    key = '%s|%d|%d' % (os.path.abspath(filename), st.st_size, st.st_mtime_ns)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def CachePath(key, ext):
+    return os.path.join(CACHE_DIR, key + ext)
+
+def LoadCachedSound(key):
+    if not USE_SAMPLE_CACHE:
+        return None
+    try:
+        with numpy.load(CachePath(key, '.npz')) as f:
+            return int(f['loop']), int(f['nframes']), float(f['tune']), int(f['numchan']), f['data']
+    except (OSError, KeyError, ValueError):
+        return None
+
+def StoreCachedSound(filename, key, loop, nframes, tune, numchan, data):
+    if not USE_SAMPLE_CACHE:
+        return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = CachePath(key, '.npz')
+        with open(path + '.tmp', 'wb') as f:
+            numpy.savez(f, loop=loop, nframes=nframes, tune=tune, numchan=numchan, data=data)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        writeToLog('Could not cache %s: %s' % (filename, e))
+
+
+#########################################
+# SAMPLE ANALYSIS
+#
+#########################################
+
+def AnalyseSound(data, loop, numchan):
+    # Onset (first frame above ONSET_THRESHOLD_DB of the peak, moved back to a zero crossing),
+    # peak and RMS levels, and zero-crossing loop points for samples without a smpl chunk
+    frames = data.reshape(-1, numchan).astype(numpy.float32)
+    left = frames[:, 0]
+    level = numpy.abs(frames).max(axis=1)
+    peak = float(level.max()) if len(level) else 0.0
+    rms = float(numpy.sqrt(numpy.mean(frames ** 2))) if len(frames) else 0.0
+
+    onset = 0
+    if peak > 0:
+        first = int(numpy.argmax(level > peak * 10 ** (ONSET_THRESHOLD_DB / 20.0)))
+        start = max(0, first - SAMPLERATE // 200)          # look back at most 5 ms for a zero crossing
+        crossings = numpy.flatnonzero(numpy.signbit(left[start:first]) != numpy.signbit(left[start + 1:first + 1]))
+        onset = start + int(crossings[-1]) + 1 if len(crossings) else start
+    if loop != -1:
+        onset = min(onset, loop)
+
+    autoloop = None
+    if loop == -1 and len(left) > 8:
+        rising = numpy.flatnonzero((left[:-1] < 0) & (left[1:] >= 0)) + 1
+        rising = rising[(rising >= len(left) // 2) & (rising <= len(left) - 4)]
+        if len(rising) > 1 and rising[0] > onset:
+            autoloop = [int(rising[0]), int(rising[-1])]
+
+    return {'threshold': ONSET_THRESHOLD_DB, 'onset': onset, 'peak': peak, 'rms': rms, 'autoloop': autoloop}
+
+def LoadAnalysis(key):
+    if not USE_SAMPLE_CACHE:
+        return None
+    try:
+        with open(CachePath(key, '.json')) as f:
+            info = json.load(f)
+        return info if info.get('threshold') == ONSET_THRESHOLD_DB else None
+    except (OSError, ValueError):
+        return None
+
+def StoreAnalysis(filename, key, info):
+    if not USE_SAMPLE_CACHE:
+        return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = CachePath(key, '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(info, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        writeToLog('Could not cache %s: %s' % (filename, e))
+
 
 #########################################
 # MIXER CLASSES
@@ -132,17 +315,30 @@ class waveread(wave.Wave_read):
 
 class PlayingSound:
 
-    def __init__(self, sound, note):
+    def __init__(self, sound, note, gain=1.0, cents=0.0):
         self.sound = sound
+        self.gain = gain
         self.pos = 0
         self.fadeoutpos = 0
         self.isfadeout = False
         self.note = note
+        self.eventtime = None
+        self.fadeoutstep = 1
+        self.cents = (note - sound.midinote) * 100 + sound.tune + cents     # pitch relative to the recording, before pitch bend
+        self.speed = self.targetspeed = PitchToSpeed(self.cents + pitchbend)
+
+    def bend(self, cents):
+        self.targetspeed = PitchToSpeed(self.cents + cents)     # the mixer glides to it over one block
 
     def fadeout(self):
         if self.sound.playbackMode == 1:
             self.isfadeout = True
 
+    def crossfade(self):
+        # Short fade when another voice takes over, whatever the playback mode
+        self.isfadeout = True
+        self.fadeoutstep = max(self.fadeoutstep, CROSSFADESTEP)
+
     def stop(self):
         try:
             playingsounds.remove(self)
@@ -153,51 +349,301 @@ class PlayingSound:
 class Sound:
 
     def __init__(self, filename, midinote, velocity, playbackMode):
-        wf = waveread(filename)
         self.fname = filename
         self.midinote = midinote
         self.velocity = velocity
         self.playbackMode = playbackMode
-        if wf.getloops():
-            self.loop = wf.getloops()[0][0]
-            self.nframes = wf.getloops()[0][1] + 2
+        self.cachekey = CacheKey(filename)
+        cached = LoadCachedSound(self.cachekey)
+        if cached:
+            self.loop, self.nframes, self.tune, self.numchan, self.data = cached
         else:
-            self.loop = -1
-            self.nframes = wf.getnframes()
-
-        self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), wf.getnchannels())
-
-        wf.close()
-
-    def play(self, note):
-        snd = PlayingSound(self, note)
+            wf = waveread(filename)
+            if wf.getloops():
+                self.loop = wf.getloops()[0][0]
+                self.nframes = wf.getloops()[0][1] + 2
+            else:
+                self.loop = -1
+                self.nframes = wf.getnframes()
+            self.tune = -wf.getpitchfraction()      # cents, brings a sample recorded sharp of its note back in tune
+            self.numchan = wf.getnchannels()
+
+            self.data = self.frames2array(wf.readframes(self.nframes), wf.getsampwidth(), self.numchan)
+
+            wf.close()
+            StoreCachedSound(filename, self.cachekey, self.loop, self.nframes, self.tune, self.numchan, self.data)
+        frames = len(self.data) // self.numchan
+        if self.nframes > frames:       # a file still being copied, or a loop end past the data: the mixer must not read past it
+            self.nframes = frames
+            if self.loop >= frames - 2:
+                self.loop = -1
+        self.analyse()
+
+    def analyse(self):
+        info = LoadAnalysis(self.cachekey)
+        if info is None:
+            info = AnalyseSound(self.data, self.loop, self.numchan)
+            StoreAnalysis(self.fname, self.cachekey, info)
+        self.peak = info['peak']
+        self.rms = info['rms']
+        self.gain = 1.0
+        if NORMALIZE_SAMPLES and self.peak > 0:
+            self.gain = 32767 * 10 ** (NORMALIZE_PEAK_DB / 20.0) / self.peak
+        if AUTO_LOOP and self.loop == -1 and self.playbackMode == 1 and info['autoloop']:
+            self.loop = info['autoloop'][0]
+            self.nframes = info['autoloop'][1] + 2
+        if TRIM_SILENCE and info['onset'] > 0:
+            onset = info['onset']
+            self.data = self.data[self.numchan * onset:]
+            self.nframes -= onset
+            if self.loop != -1:
+                self.loop -= onset
+
+    def play(self, note, gain=1.0, cents=0.0):
+        snd = PlayingSound(self, note, gain, cents)
         playingsounds.append(snd)
         return snd
 
     def frames2array(self, data, sampwidth, numchan):
+        # Mono samples stay mono, the mixer renders them once and copies them to both channels
         if sampwidth == 2:
-            npdata = numpy.fromstring(data, dtype=numpy.int16)
+            npdata = numpy.frombuffer(data, dtype=numpy.int16)
         elif sampwidth == 3:
-            npdata = samplerbox_audio.binary24_to_int16(data, len(data)/3)
-        if numchan == 1:
-            npdata = numpy.repeat(npdata, 2)
+            npdata = samplerbox_audio.binary24_to_int16(data, len(data)//3)
         return npdata
 
+class Layer:
+    # The samples of one preset as played from a pedal: with a gain, a transpose and a key range.
+    # A split layer owns its key range, the other layers don't sound there.
+
+    def __init__(self, samples, gain=1.0, transpose=0, low=0, high=127, split=False):
+        self.samples = samples
+        self.gain = gain
+        self.transpose = transpose
+        self.low = low
+        self.high = high
+        self.split = split
+
+class Preset:
+    # Everything the note path needs from a preset. Built completely by the loader thread,
+    # then published with a single reference swap and never modified again.
+
+    def __init__(self, index, layers=[], volume=10 ** (-12.0/20), mono=False, tuning=[0.0] * 12):
+        self.index = index
+        self.layers = layers
+        self.volume = volume
+        self.mono = mono
+        self.tuning = tuning        # cents from equal temperament for each pitch class, c first
+        self.notelayers = []        # the layers each note plays
+        for note in range(128):
+            notelayers = [layer for layer in layers if layer.low <= note <= layer.high]
+            if any(layer.split for layer in notelayers):
+                notelayers = [layer for layer in notelayers if layer.split]
+            self.notelayers.append(notelayers)
+
 FADEOUTLENGTH = 200000
 FADEOUT = numpy.linspace(1., 0., FADEOUTLENGTH)            # by default, float64
 FADEOUT = numpy.power(FADEOUT, 6)
 FADEOUT = numpy.append(FADEOUT, numpy.zeros(FADEOUTLENGTH, numpy.float32)).astype(numpy.float32)
-SPEED = numpy.power(2, numpy.arange(0.0, 84.0)/12).astype(numpy.float32)
-
-samples = {}
+FADEOUT_Q15 = numpy.round(FADEOUT * 32767).astype(numpy.int16)       # for the fixed-point kernel
+CROSSFADESTEP = int(FADEOUTLENGTH / (CROSSFADE_SECS * SAMPLERATE))
+PITCHSTEPS = 10             # table entries per cent
+PITCHRANGE = 8400           # cents up or down
+PITCH = numpy.power(2, numpy.arange(-PITCHRANGE * PITCHSTEPS, PITCHRANGE * PITCHSTEPS + 1) / (1200.0 * PITCHSTEPS)).astype(numpy.float32)
+
+def PitchToSpeed(cents):
+    i = int(round((cents + PITCHRANGE) * PITCHSTEPS))
+    return float(PITCH[min(max(i, 0), len(PITCH) - 1)])
+
+TEMPERAMENTS = {            # cents from equal temperament, c to b
+    'equal': [0.0] * 12,
+    'pythagorean': [0.0, -9.8, 3.9, -5.9, 7.8, -2.0, 11.7, 2.0, -7.8, 5.9, -3.9, 9.8],
+    'just': [0.0, 11.7, 3.9, 15.6, -13.7, -2.0, -9.8, 2.0, 13.7, -15.6, -3.9, -11.7],
+    'meantone': [0.0, -24.0, -6.8, 10.3, -13.7, 3.4, -20.5, -3.4, -27.4, -10.3, 6.8, -17.1],
+    'werckmeister3': [0.0, -9.8, -7.8, -5.9, -9.8, -2.0, -11.7, -3.9, -7.8, -11.7, -3.9, -7.8],
+}
+
+preset = Preset(None)
 playingnotes = {}
 sustainplayingnotes = []
-sustain = True
+sustain = False
 playingsounds = []
-last_played_per_note = [0] * MAX_POLYPHONY
-note_active = [0] * MAX_POLYPHONY
-globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
-globaltranspose = 0
+last_played_per_note = [0] * 128
+note_active = [0] * 128
+latencies = collections.deque(maxlen=1000)   # event time to DAC time of the first block of each voice, in seconds
+globalvolume = preset.volume
+pitchbend = 0.0         # cents
+audiothreadid = None
+monovoices = []
+sounds = {}             # the Sounds of the published preset and its layers, reused by the next load
+presetIndex = 0
+
+
+#########################################
+# QUALITY GOVERNOR
+#
+#########################################
+
+def Loudness(snd):
+    if snd.isfadeout:
+        return FADEOUT[min(snd.fadeoutpos, FADEOUTLENGTH)] * snd.sound.velocity
+    return snd.sound.velocity
+
+class QualityGovernor:
+    # Watches the render time of each audio block and steps quality down before the deadline is missed:
+    # level 1 shortens release tails, level 2 also steals the quietest voices, level 3 also stops interpolating
+
+    def __init__(self):
+        self.level = 0
+        self.holdblocks = 0
+        self.goodblocks = 0
+        self.underflows = 0
+        self.events = collections.deque(maxlen=100)     # transitions, logged from the main thread
+
+    def Update(self, rendertime, frame_count, underflow):
+        load = rendertime * SAMPLERATE / frame_count
+        if underflow:
+            self.underflows += 1
+        if self.holdblocks > 0:
+            self.holdblocks -= 1
+        if underflow or load > GOVERNOR_HIGH_LOAD:
+            self.goodblocks = 0
+            if self.level < 3 and self.holdblocks == 0:
+                self.SetLevel(self.level + 1, load, underflow)
+        elif load < GOVERNOR_LOW_LOAD:
+            self.goodblocks += 1
+            if self.level > 0 and self.goodblocks >= GOVERNOR_RECOVER_BLOCKS:
+                self.SetLevel(self.level - 1, load, underflow)
+        else:
+            self.goodblocks = 0
+
+    def SetLevel(self, level, load, underflow):
+        self.events.append((time.time(), self.level, level, load, underflow))
+        self.level = level
+        self.holdblocks = GOVERNOR_HOLD_BLOCKS
+        self.goodblocks = 0
+
+    def Polyphony(self):
+        return MAX_POLYPHONY if self.level < 2 else max(2, MAX_POLYPHONY // 2)
+
+    def StealVoices(self, sounds):
+        # Voices over the polyphony are faded out quickly rather than cut, quietest first
+        active = [snd for snd in sounds if snd.fadeoutstep < CROSSFADESTEP]
+        excess = len(active) - self.Polyphony()
+        if excess > 0:
+            active.sort(key=Loudness)
+            for snd in active[:excess]:
+                snd.crossfade()
+
+    def LogEvents(self):
+        while self.events:
+            eventtime, old, new, load, underflow = self.events.popleft()
+            writeToLog('Governor: quality level %d -> %d, load %d%%%s, %d underflows so far' % (
+                old, new, load * 100, ' (underflow)' if underflow else '', self.underflows))
+
+governor = QualityGovernor()
+
+
+#########################################
+# RECORDER
+#
+#########################################
+
+class Recorder:
+    # Single producer, single consumer ring buffer: the audio callback only copies its block in and moves
+    # writepos, the writer thread drains it to disk in large sequential writes and moves readpos.
+    # No locks, the audio thread never waits: when the ring is full the block is dropped and counted.
+
+    def __init__(self, seconds=RECORD_BUFFER_SECS, channels=2):
+        self.size = int(seconds * SAMPLERATE)
+        self.channels = channels
+        self.buffer = None
+        self.writepos = 0           # frames, only the audio thread moves it
+        self.readpos = 0            # frames, only the writer thread moves it
+        self.overflows = 0
+        self.active = False
+        self.thread = None
+        self.filename = None
+
+    def prepare(self):
+        # Allocated once and touched here, so that the audio thread doesn't page-fault into it
+        if self.buffer is None:
+            self.buffer = numpy.zeros((self.size, self.channels), numpy.int16)
+        self.buffer.fill(0)
+        self.writepos = self.readpos = 0
+
+    def push(self, block):
+        if not self.active:
+            return
+        n = len(block)
+        if self.writepos - self.readpos + n > self.size:
+            self.overflows += 1
+            return
+        i = self.writepos % self.size
+        first = min(n, self.size - i)
+        self.buffer[i:i + first] = block[:first]
+        self.buffer[:n - first] = block[first:]
+        self.writepos += n
+
+    def start(self):
+        if self.thread:
+            self.stop()
+        self.prepare()
+        os.makedirs(RECORD_DIR, exist_ok=True)
+        self.filename = os.path.join(RECORD_DIR, time.strftime('samplerbox-%Y%m%d-%H%M%S.') + RECORD_FORMAT)
+        self.active = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.active = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        overflows = self.overflows
+        try:
+            if RECORD_FORMAT == 'flac':
+                import soundfile
+                out = soundfile.SoundFile(self.filename, 'w', SAMPLERATE, self.channels, 'PCM_16', format='FLAC')
+                write = out.write
+            else:
+                out = wave.open(self.filename, 'wb')
+                out.setnchannels(self.channels)
+                out.setsampwidth(2)
+                out.setframerate(SAMPLERATE)
+                write = lambda frames: out.writeframes(frames.tobytes())
+            writeToLog('Recording to ' + self.filename)
+            while self.active or self.readpos < self.writepos:
+                available = self.writepos - self.readpos
+                if self.active and available < SAMPLERATE // 2:
+                    time.sleep(0.1)
+                    continue
+                i = self.readpos % self.size
+                n = min(available, self.size - i)
+                write(self.buffer[i:i + n])
+                self.readpos += n
+            out.close()
+            writeToLog('Recording stopped: %s, %.1f s, %d blocks dropped' % (
+                self.filename, self.writepos / float(SAMPLERATE), self.overflows - overflows))
+        except BaseException as e:
+            self.active = False
+            writeToLog('Failed in Recorder.run(): ' + str(e))
+
+recorder = Recorder()
+
+def ToggleRecording():
+    if recorder.active:
+        display.print7seg('StOP')
+        recorder.stop()
+    else:
+        try:
+            recorder.start()
+            display.print7seg('rEC ')
+        except OSError as e:
+            writeToLog('Cannot record: ' + str(e))
+            display.print7seg('Err ')
 
 
 #########################################
@@ -206,37 +652,355 @@ globaltranspose = 0
 #########################################
 
 def AudioCallback(outdata, frame_count, time_info, status):
-    global playingsounds
+    global audiothreadid
+    starttime = time.perf_counter()
+    if audiothreadid is None:
+        audiothreadid = threading.get_native_id()
     rmlist = []
-    playingsounds = playingsounds[-MAX_POLYPHONY:]
-    b = samplerbox_audio.mixaudiobuffers(playingsounds, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, SPEED)
+    if len(playingsounds) > 2 * MAX_POLYPHONY:
+        del playingsounds[:-2 * MAX_POLYPHONY]     # safety net, the governor normally fades out voices over the polyphony
+    governor.StealVoices(playingsounds)
+    dactime = time.time() + time_info.outputBufferDacTime - time_info.currentTime
+    for snd in playingsounds:
+        if snd.eventtime is not None:
+            latencies.append(dactime - snd.eventtime)
+            snd.eventtime = None
+        if governor.level >= 1 and snd.isfadeout and snd.fadeoutstep < GOVERNOR_TAILSTEP:
+            snd.fadeoutstep = GOVERNOR_TAILSTEP
+    if FIXED_POINT_MIXER:
+        b = samplerbox_audio.mixaudiobuffers_fixed(playingsounds, rmlist, frame_count, FADEOUT_Q15, FADEOUTLENGTH, governor.level < 3, int(globalvolume * 32768))
+    else:
+        b = samplerbox_audio.mixaudiobuffers(playingsounds, rmlist, frame_count, FADEOUT, FADEOUTLENGTH, governor.level < 3)
+        b *= globalvolume
     for e in rmlist:
         try:
             playingsounds.remove(e)
         except:
             pass
-    b *= globalvolume
     outdata[:] = b.reshape(outdata.shape)
-
-def PlayNoteCallback(midinote, state, event_time):
-#    print("playing" + str(midinote))
-    global playingnotes, sustain, sustainplayingnotes
+    recorder.push(outdata)
+    governor.Update(time.perf_counter() - starttime, frame_count, status.output_underflow)
+
+def NoteOn(midinote, velocity, event_time):
+    current = preset        # read once, a preset swap can happen at any time
+    voices = []
+    for layer in current.notelayers[midinote]:
+        note = midinote + layer.transpose
+        sound = layer.samples.get((note, velocity))
+        if sound:
+            snd = sound.play(note, layer.gain * sound.gain, current.tuning[note % 12])
+            snd.eventtime = event_time
+            voices.append(snd)
+    if not voices:
+        return
+    for snd in playingnotes.get(midinote, []):
+        snd.fadeout()
+    playingnotes[midinote] = voices
+    if current.mono:
+        MonoHandover(voices)
+
+def MonoHandover(voices):
+    # A held note hands over to the new one with a short crossfade instead of stacking voices,
+    # released notes keep their natural tail but only the most recent MONO_MAX_TAILS of them
+    global monovoices
+    for snd in monovoices:
+        snd.crossfade()
+    monovoices = voices
+    tails = [other for other in list(playingsounds) if other not in voices and other.fadeoutstep == 1]
+    for other in tails[:max(0, len(tails) - MONO_MAX_TAILS * len(voices))]:
+        other.crossfade()
+
+def NoteOff(midinote):
+    global monovoices
+    voices = playingnotes.pop(midinote, [])
+    if voices and voices is monovoices:
+        monovoices = []
+    for snd in voices:
+        if sustain:
+            sustainplayingnotes.append(snd)
+        else:
+            snd.fadeout()
+
+def SustainPedal(state):
+    global sustain
+    sustain = state
+    if not sustain:
+        for snd in sustainplayingnotes:
+            snd.fadeout()
+        sustainplayingnotes.clear()
+
+def PitchBend(value):
+    global pitchbend
+    pitchbend = (value - 8192) * PITCHBEND_RANGE * 100.0 / 8192
+    for snd in list(playingsounds):
+        snd.bend(pitchbend)
+
+def Panic():
+    global monovoices
+    monovoices = []
+    playingnotes.clear()
+    sustainplayingnotes.clear()
+    playingsounds.clear()
+
+def PlayNoteCallback(midinote, state, event_time, velocity=127):
+    # Pedal path: debounced on both edges, the polling loop calls this on every pass
+    if state != note_active[midinote] and event_time - last_played_per_note[midinote] > DEBOUNCE_SECS:
+        last_played_per_note[midinote] = event_time
+        note_active[midinote] = state
+        if state:
+            NoteOn(midinote, velocity, event_time)
+        else:
+            NoteOff(midinote)
+
+MIDI_DATALENGTH = {8: 2, 9: 2, 10: 2, 11: 2, 12: 1, 13: 1, 14: 2}
+
+class MidiParser:
+    # Incremental MIDI byte stream parser, handles running status, ignores sysex and realtime bytes
+
+    def __init__(self):
+        self.status = 0
+        self.data = []
+
+    def feed(self, data):
+        messages = []
+        for byte in data:
+            if byte >= 0xF8:                # realtime, can appear anywhere
+                continue
+            if byte >= 0x80:
+                self.status = byte if byte < 0xF0 else 0      # system common and sysex cancel running status
+                self.data = []
+                continue
+            if not self.status:
+                continue
+            self.data.append(byte)
+            if len(self.data) == MIDI_DATALENGTH[self.status >> 4]:
+                messages.append([self.status] + self.data + [0] * (2 - len(self.data)))
+                self.data = []
+        return messages
+
+def MidiCallback(message, event_time):
     global presetIndex
-    velocity = 127
-    
-    if event_time - last_played_per_note[midinote] > DEBOUNCE_SECS:
-        if state == True:
-            last_played_per_note[midinote] = event_time
-        midinote += globaltranspose
-        try:
-            if state == True and not note_active[midinote]:
-                playingnotes[midinote] = samples[midinote, velocity].play(midinote)
+    messagetype = message[0] >> 4
+    if MIDI_CHANNEL is not None and message[0] & 15 != MIDI_CHANNEL:
+        return
+    note = message[1]
+    velocity = message[2]
+    if messagetype == 9 and velocity == 0:
+        messagetype = 8
+    if messagetype == 9:    # Note on
+        NoteOn(note, velocity, event_time)
+    elif messagetype == 8:  # Note off
+        NoteOff(note)
+    elif messagetype == 14:  # Pitch bend
+        PitchBend(note | velocity << 7)
+    elif messagetype == 12:  # Program change
+        presetIndex = note
+        LoadSamples()
+    elif messagetype == 11 and note == 64:  # Sustain pedal
+        SustainPedal(velocity >= 64)
+    elif messagetype == 11 and note in (120, 123):  # All sound off, all notes off
+        Panic()
+
+def LatencyReport():
+    if not latencies:
+        return None
+    values = sorted(latencies)
+    n = len(values)
+    return 'Latency over %d notes: median %.1f ms, p95 %.1f ms, max %.1f ms' % (
+        n, values[n // 2] * 1000, values[min(n - 1, int(n * 0.95))] * 1000, values[-1] * 1000)
+
+#########################################
+# SAMPLE LIBRARY INDEX
+#
+#########################################
+
+library = {}            # preset number -> {'dir': folder name, 'mtime': folder mtime, 'files': {name: [size, mtime, format]}}, see SampleFormat()
+libraryroot = None      # the folder the index describes
+LibraryLock = threading.Lock()
+
+def LibraryRoot():
+    return SAMPLES_DIR if os.path.isdir(SAMPLES_DIR) and os.listdir(SAMPLES_DIR) else '.'      # use current folder (containing 0 Saw) if no user media containing samples has been found
+
+def SampleFormat(path):
+    # [sample width, channels, sample rate] of a WAV file, False for other or unreadable files
+    # (None in the index until DetectFormats() got to the file)
+    if not path.lower().endswith('.wav'):
+        return False
+    try:
+        wf = waveread(path)
+        fmt = [wf.getsampwidth(), wf.getnchannels(), wf.getframerate()]
+        wf.close()
+        return fmt
+    except Exception:
+        return False
+
+def ScanPresetFolder(path, previous):
+    # Stat only, new or modified files get their format later from DetectFormats()
+    files = {}
+    for entry in os.scandir(path):
+        if entry.is_file():
+            st = entry.stat()
+            old = previous.get(entry.name)
+            if old and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                files[entry.name] = old
             else:
-                playingnotes[midinote].fadeout()
-                del playingnotes[midinote]
-        except:
-            pass
-    note_active[midinote] = state
+                files[entry.name] = [st.st_size, st.st_mtime_ns, None]
+    return files
+
+def ScanLibrary(dirty=()):
+    # Brings the index up to date with a stat per preset folder, listing only the folders whose mtime changed
+    # and those in dirty (a sample rewritten in place doesn't change its folder's mtime). Returns True if anything changed.
+    global library, libraryroot
+    with LibraryLock:
+        root = LibraryRoot()
+        newlibrary = {}
+        for entry in sorted(os.scandir(root), key=lambda entry: entry.name):
+            m = re.match(r'(\d+) ', entry.name)
+            if not m or int(m.group(1)) in newlibrary:
+                continue
+            index = int(m.group(1))
+            try:
+                if not entry.is_dir():
+                    continue
+                mtime = entry.stat().st_mtime_ns
+                old = library.get(index) if root == libraryroot else None
+                if old and old['dir'] == entry.name and old['mtime'] == mtime and index not in dirty:
+                    newlibrary[index] = old
+                else:
+                    previous = old['files'] if old and old['dir'] == entry.name else {}
+                    newlibrary[index] = {'dir': entry.name, 'mtime': mtime, 'files': ScanPresetFolder(entry.path, previous)}
+            except OSError:
+                pass            # removed while scanning
+        changed = root != libraryroot or newlibrary != library
+        library = newlibrary
+        libraryroot = root
+    if changed:
+        writeToLog('Library: %d presets in %s' % (len(library), os.path.abspath(root)))
+        StoreLibrary()
+    return changed
+
+def DetectFormats():
+    # Opens the files the scans only stat'ed. Runs on the watcher thread, so that boot and preset loads don't wait for it
+    found = False
+    for entry in list(library.values()):
+        for name, info in list(entry['files'].items()):
+            if info[2] is None:
+                info[2] = SampleFormat(os.path.join(libraryroot, entry['dir'], name))
+                found = True
+    if found:
+        StoreLibrary()
+
+def LoadLibrary():
+    # The index of the previous boot, so that unchanged preset folders are not listed again
+    global library, libraryroot
+    if not USE_SAMPLE_CACHE:
+        return
+    try:
+        with open(os.path.join(CACHE_DIR, 'library.json')) as f:
+            stored = json.load(f)
+        library = {int(index): entry for index, entry in stored['presets'].items()}
+        libraryroot = stored['root']
+    except (OSError, ValueError, KeyError):
+        pass
+
+def StoreLibrary():
+    if not USE_SAMPLE_CACHE:
+        return
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = os.path.join(CACHE_DIR, 'library.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'root': libraryroot, 'presets': library}, f)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        writeToLog('Could not store the library index: %s' % e)
+
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+LIBRARY_EVENTS = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+def ReadInotify(fd):
+    # (watch descriptor, mask) of every pending event
+    data = b''
+    while True:
+        try:
+            chunk = os.read(fd, 4096)
+        except BlockingIOError:
+            break
+        if not chunk:
+            break
+        data += chunk
+    events = []
+    offset = 0
+    while offset + 16 <= len(data):
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+        events.append((wd, mask))
+        offset += 16 + length
+    return events
+
+def WatchLibrary():
+    # Keeps the index current: inotify where the kernel has it, and a LIBRARY_POLL_SECS stat poll for the rest
+    # (media mounted over SAMPLES_DIR, file systems without inotify). Reloads the current preset when its folder changes.
+    fd = -1
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        pass
+    if fd < 0:
+        writeToLog('Library: no inotify, polling every %s s' % LIBRARY_POLL_SECS)
+    watches = {}            # watch descriptor -> preset number, None for the library root
+    watched = set()
+    pending = None          # (preset, time) the current preset's folder last changed, it reloads once it stays the same for LIBRARY_POLL_SECS
+    PresetLoaded.wait()     # the first preset doesn't share the disk with the format scan
+    DetectFormats()
+    while True:
+        if fd >= 0:
+            folders = [(None, libraryroot)] + [(index, os.path.join(libraryroot, entry['dir'])) for index, entry in library.items()]
+            for index, path in folders:
+                if path not in watched:
+                    wd = libc.inotify_add_watch(fd, os.fsencode(os.path.abspath(path)), LIBRARY_EVENTS)
+                    if wd >= 0:
+                        watches[wd] = index
+                        watched.add(path)
+        dirty = set()
+        if fd >= 0 and select.select([fd], [], [], LIBRARY_POLL_SECS)[0]:
+            time.sleep(0.2)     # a file copy sends a burst of events, handle them in one go
+            for wd, mask in ReadInotify(fd):
+                if mask & IN_Q_OVERFLOW:
+                    dirty.update(library)
+                elif mask & IN_IGNORED:
+                    watches.pop(wd, None)
+                    watched.clear()         # the next pass watches the folders that still exist again, inotify returns the same wd
+                elif watches.get(wd) is not None:
+                    dirty.add(watches[wd])
+        elif fd < 0:
+            time.sleep(LIBRARY_POLL_SECS)
+        index = presetIndex
+        if pending and pending[0] == index:
+            dirty.add(index)        # sizes are re-read until a copy into the folder has finished
+        current = library.get(index)
+        try:
+            changed = ScanLibrary(dirty)
+        except OSError as e:
+            writeToLog('Library scan failed: %s' % e)
+            continue
+        if library.get(index) != current:
+            pending = (index, time.time())
+        elif pending and time.time() - pending[1] >= LIBRARY_POLL_SECS:
+            if pending[0] == index == presetIndex:
+                writeToLog('Library: preset %d changed on disk, reloading' % index)
+                LoadSamples()
+            pending = None
+        if changed:
+            DetectFormats()
+
 
 #########################################
 # LOAD SAMPLES
@@ -245,107 +1009,217 @@ def PlayNoteCallback(midinote, state, event_time):
 
 LoadingThread = None
 LoadingInterrupt = False
+PresetLoaded = threading.Event()
+LoadingLock = threading.Lock()       # the buttons, MIDI and library watcher threads all ask for loads
 
 
 def LoadSamples():
     global LoadingThread
     global LoadingInterrupt
 
-    if LoadingThread:
-        LoadingInterrupt = True
-        LoadingThread.join()
-        LoadingThread = None
+    with LoadingLock:
+        if LoadingThread:
+            LoadingInterrupt = True
+            LoadingThread.join()
+            LoadingThread = None
 
-    LoadingInterrupt = False
-    LoadingThread = threading.Thread(target=ActuallyLoad)
-    LoadingThread.daemon = True
-    LoadingThread.start()
+        LoadingInterrupt = False
+        LoadingThread = threading.Thread(target=ActuallyLoad)
+        LoadingThread.daemon = True
+        LoadingThread.start()
 
 NOTES = ["c", "c#", "d", "d#", "e", "f", "f#", "g", "g#", "a", "a#", "b"]
 
-def ActuallyLoad():
+def FillSampleMap(samples):
+    # Fills in every (midinote, velocity) from the loaded samples, returns how many were loaded
+    initial_keys = set(samples.keys())
+    for midinote in range(128):
+        lastvelocity = None
+        for velocity in range(128):
+            if (midinote, velocity) not in initial_keys:
+                samples[midinote, velocity] = lastvelocity
+            else:
+                if not lastvelocity:
+                    for v in range(velocity):
+                        samples[midinote, v] = samples[midinote, velocity]
+                lastvelocity = samples[midinote, velocity]
+        if not lastvelocity:
+            for velocity in range(128):
+                try:
+                    samples[midinote, velocity] = samples[midinote-1, velocity]
+                except:
+                    pass
+    return len(initial_keys)
+
+def PublishPreset(newpreset, newsounds):
+    # Single reference swap: the note path sees either the old or the new preset, never a partial one.
+    # Notes from the old preset keep their own Sound data and finish with a short crossfade.
+    global preset, globalvolume, monovoices, sounds
+    preset = newpreset
+    globalvolume = newpreset.volume
+    monovoices = []
+    sounds = newsounds
+    for snd in list(playingsounds):
+        snd.crossfade()
+
+def LoadSound(filename, midinote, velocity, mode, newsounds):
+    # A sample used by several layers, or by the previous preset, is only loaded once
+    key = (filename, os.path.getmtime(filename), midinote, velocity, mode)
+    if key not in newsounds:
+        newsounds[key] = sounds.get(key) or Sound(filename, midinote, velocity, mode)
+    return newsounds[key]
+
+def LoadPresetSound(dirname, fname, files, midinote, velocity, mode, newsounds):
+    # A file that can't be loaded is logged, marked unreadable in the library index and left out of the preset
     try:
-        global presetIndex
-        global samples
-        global playingsounds
-        global globalvolume, globaltranspose
-        playingsounds = []
-        samples = {}
-        globalvolume = 10 ** (-12.0/20)  # -12dB default global volume
-        globaltranspose = 0
-
-        samplesdir = SAMPLES_DIR if os.listdir(SAMPLES_DIR) else '.'      # use current folder (containing 0 Saw) if no user media containing samples has been found
-
-        basename = next((f for f in os.listdir(samplesdir) if f.startswith("%d " % presetIndex)), None)      # or next(glob.iglob("blah*"), None)
-        if basename:
-            dirname = os.path.join(samplesdir, basename)
-        if not basename:
-            writeToLog('Preset empty: %s' % presetIndex)
-            display.print7seg("E%03d" % presetIndex)
-            return
-        writeToLog('Preset loading: %s (%s)' % (presetIndex, basename))
-        display.print7seg("L%03d" % presetIndex)
-
-        definitionfname = os.path.join(dirname, "definition.txt")
-        print('Loading def=' + definitionfname)
-        if os.path.isfile(definitionfname):
-            with open(definitionfname, 'r') as definitionfile:
-                for i, entry in enumerate(definitionfile):
-                    m = re.match('(?:volume=)(?P<volume>-*\d)', entry)
-                    if m:
-                        presetVolume = int(m.groupdict().get('volume', 0))-12
-                        globalvolume = 10 ** (presetVolume/20)
-                        continue
+        return LoadSound(os.path.join(dirname, fname), midinote, velocity, mode, newsounds)
+    except Exception as e:
+        writeToLog('Cannot load %s: %s' % (os.path.join(dirname, fname), e))
+        files[fname][2] = False
+        return None
+
+def ReadPreset(index, newsounds):
+    # Returns (basename, samples, volume, mono, tuning, layer definitions) of a preset, or None if there is no such preset
+    # or the load was interrupted (check LoadingInterrupt to tell them apart)
+    entry = library.get(index)
+    if not entry:
+        ScanLibrary()           # media inserted since the last scan
+        entry = library.get(index)
+        if not entry:
+            return None
+    basename = entry['dir']
+    dirname = os.path.join(libraryroot, basename)
+    files = entry['files']
+    samples = {}
+    presetvolume = 10 ** (-12.0/20)  # -12dB default global volume
+    mono = False
+    tune = 0.0
+    temperament = TEMPERAMENTS['equal']
+    root = 0
+    layerdefs = []
+
+    definitionfname = os.path.join(dirname, "definition.txt")
+    print('Loading def=' + definitionfname)
+    if "definition.txt" in files:
+        with open(definitionfname, 'r') as definitionfile:
+            for i, entry in enumerate(definitionfile):
+                if LoadingInterrupt:
+                    return None
+                m = re.match(r'(?:volume=)(?P<volume>-*\d)', entry)
+                if m:
+                    presetVolume = int(m.groupdict().get('volume', 0))-12
+                    presetvolume = 10 ** (presetVolume/20)
+                    continue
+                m = re.match(r'mono=(?P<mono>[01])', entry)
+                if m:
+                    mono = m.group('mono') == '1'
+                    continue
+                m = re.match(r'tune=(?P<cents>-?[\d.]+)', entry)
+                if m:
+                    tune = float(m.group('cents'))
+                    continue
+                m = re.match(r'temperament=(?P<temperament>[\w.,-]+)', entry)
+                if m:
                     try:
-                        defaultparams = {'midinote': '0', 'velocity': '127', 'notename': '', 'mode': '0'}
-                        pattern = '(?P<midinote>\d*)_(?P<mode>\d*)\.wav'
-                        for fname in os.listdir(dirname):
-                            m = re.match(pattern, fname)
-                            if m:
-                                info = m.groupdict()
-                                midinote = int(info.get('midinote', defaultparams['midinote']))
-                                velocity = int(info.get('velocity', defaultparams['velocity']))
-                                notename = info.get('notename', defaultparams['notename'])
-                                mode = int(info.get('mode', defaultparams['mode']))
-                                if notename:
-                                    midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
-                                samples[midinote, velocity] = Sound(os.path.join(dirname, fname), midinote, velocity, mode)
-                    except:
+                        values = m.group('temperament').split(',')
+                        temperament = TEMPERAMENTS[values[0].lower()] if len(values) == 1 else [float(v) for v in values]
+                        if len(temperament) != 12:
+                            raise ValueError('temperament needs 12 values')
+                        keyroot = re.search(r'root=([a-gA-G]#?)', entry)
+                        root = NOTES.index(keyroot.group(1).lower()) if keyroot else 0
+                    except (KeyError, ValueError):
+                        temperament, root = TEMPERAMENTS['equal'], 0
                         print("Error in definition file, skipping line %s." % (i+1))
+                    continue
+                m = re.match(r'(?P<kind>layer|split)=(?P<preset>\d+)', entry)
+                if m:
+                    gain = re.search(r'gain=(-?[\d.]+)', entry)
+                    transpose = re.search(r'transpose=(-?\d+)', entry)
+                    keyrange = re.search(r'range=(\d+)-(\d+)', entry)
+                    layerdefs.append((m.group('kind') == 'split', int(m.group('preset')),
+                                      10 ** (float(gain.group(1)) / 20) if gain else 1.0,
+                                      int(transpose.group(1)) if transpose else 0,
+                                      int(keyrange.group(1)) if keyrange else 0,
+                                      int(keyrange.group(2)) if keyrange else 127))
+                    continue
+                try:
+                    defaultparams = {'midinote': '0', 'velocity': '127', 'notename': '', 'mode': '0'}
+                    pattern = r'(?P<midinote>\d*)_(?P<mode>\d*)\.wav'
+                    for fname in sorted(files):
+                        if LoadingInterrupt:
+                            return None
+                        m = re.match(pattern, fname)
+                        if m and files[fname][2] is not False:
+                            info = m.groupdict()
+                            midinote = int(info.get('midinote', defaultparams['midinote']))
+                            velocity = int(info.get('velocity', defaultparams['velocity']))
+                            notename = info.get('notename', defaultparams['notename'])
+                            mode = int(info.get('mode', defaultparams['mode']))
+                            if notename:
+                                midinote = NOTES.index(notename[:-1].lower()) + (int(notename[-1])+2) * 12
+                            sound = LoadPresetSound(dirname, fname, files, midinote, velocity, mode, newsounds)
+                            if sound:
+                                samples[midinote, velocity] = sound
+                except:
+                    print("Error in definition file, skipping line %s." % (i+1))
+
+    else:
+        for midinote in range(0, 127):
+            if LoadingInterrupt:
+                return None
+            fname = "%d.wav" % midinote
+            if fname in files and files[fname][2] is not False:
+                sound = LoadPresetSound(dirname, fname, files, midinote, 127, 0, newsounds)
+                if sound:
+                    samples[midinote, 127] = sound
+
+    FillSampleMap(samples)
+    tuning = [tune + temperament[(pitchclass - root) % 12] for pitchclass in range(12)]
+    return basename, samples, presetvolume, mono, tuning, layerdefs
 
-        else:
-            for midinote in range(0, 127):
+def ActuallyLoad():
+    try:
+        index = presetIndex         # the buttons thread may move on while this preset loads
+        newsounds = {}
+        display.print7seg("L%03d" % index)
+        definition = ReadPreset(index, newsounds)
+        if LoadingInterrupt:
+            return              # another preset was asked for, publish nothing
+        if not definition:
+            writeToLog('Preset empty: %s' % index)
+            display.print7seg("E%03d" % index)
+            PublishPreset(Preset(index), newsounds)
+            return
+        basename, samples, presetvolume, mono, tuning, layerdefs = definition
+        writeToLog('Preset loading: %s (%s)' % (index, basename))
+
+        # Layers and splits play the samples of other presets (not their layers), each preset is read once
+        layers = [Layer(samples)]
+        layersamples = {index: samples}
+        for split, layerindex, gain, transpose, low, high in layerdefs:
+            if layerindex not in layersamples:
+                layerdefinition = ReadPreset(layerindex, newsounds)
                 if LoadingInterrupt:
                     return
-                file = os.path.join(dirname, "%d.wav" % midinote)
-                if os.path.isfile(file):
-                    samples[midinote, 127] = Sound(file, midinote, 127, 0)
+                layersamples[layerindex] = layerdefinition[1] if layerdefinition else {}
+                writeToLog('Preset %s: %s %s' % (index, 'split' if split else 'layer', layerdefinition[0] if layerdefinition else 'empty'))
+            layers.append(Layer(layersamples[layerindex], gain, transpose, low, high, split))
 
-        initial_keys = set(samples.keys())
-        for midinote in range(128):
-            lastvelocity = None
-            for velocity in range(128):
-                if (midinote, velocity) not in initial_keys:
-                    samples[midinote, velocity] = lastvelocity
-                else:
-                    if not lastvelocity:
-                        for v in range(velocity):
-                            samples[midinote, v] = samples[midinote, velocity]
-                    lastvelocity = samples[midinote, velocity]
-            if not lastvelocity:
-                for velocity in range(128):
-                    try:
-                        samples[midinote, velocity] = samples[midinote-1, velocity]
-                    except:
-                        pass
-        if len(initial_keys) > 0:
-            writeToLog('Preset loaded: ' + str(presetIndex))
-            display.print7seg("P%03d" % presetIndex)
+        if LoadingInterrupt:
+            return
+        if PERFORMANCE_MODE:
+            Prefault(newsounds.values(), index)
+        PublishPreset(Preset(index, layers, presetvolume, mono, tuning), newsounds)
+        if newsounds:
+            writeToLog('Preset loaded: ' + str(index))
+            display.print7seg("P%03d" % index)
         else:
-            writeToLog('Preset empty: ' + str(presetIndex))
-            display.print7seg("E%03d" % presetIndex)
+            writeToLog('Preset empty: ' + str(index))
+            display.print7seg("E%03d" % index)
     except BaseException as e:
-        writeToLog('Failed in ActuallyLoad(): ' + e)
+        writeToLog('Failed in ActuallyLoad(): ' + str(e))
+    finally:
+        PresetLoaded.set()
 
 
 #########################################
@@ -353,243 +1227,460 @@ def ActuallyLoad():
 #
 #########################################
 
-try:
-    sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=512, samplerate=44100, channels=2, dtype='int16', callback=AudioCallback)
-    sd.start()
-    writeToLog('Opened audio device #%i' % AUDIO_DEVICE_ID)
-except:
-    writeToLog('Invalid audio device #%i' % AUDIO_DEVICE_ID)
-    exit(1)
+sd = None
+
+def OpenAudio():
+    global sd
+    with BootStage('audio'):
+        if USE_SIMULATED_HARDWARE:
+            import simhw as sounddevice
+        else:
+            import sounddevice
+        try:
+            sd = sounddevice.OutputStream(device=AUDIO_DEVICE_ID, blocksize=BLOCKSIZE, samplerate=SAMPLERATE, channels=2, dtype='int16', callback=AudioCallback)
+            sd.start()
+            writeToLog('Opened audio device #%i' % AUDIO_DEVICE_ID)
+        except:
+            writeToLog('Invalid audio device #%i' % AUDIO_DEVICE_ID)
+            exit(1)
 
 #########################################
-# BUTTONS THREAD (RASPBERRY PI GPIO)
+# PERFORMANCE MODE
 #
 #########################################
-presetIndex = 0
-if USE_BUTTONS:
-    import numato_gpio as numato
-    lastbuttontime = 0
 
-    writeToLog('Attempting to open Numato GPIO')
-    numato_serial_fd = '/dev/ttyACM0'
-    display.print7seg('1n1+')
-    dev = numato.NumatoUsbGpio(numato_serial_fd)
-    writeToLog('Successfully opened Numato GPIO')
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+THREAD_STACK_SIZE = 256 * 1024      # MCL_FUTURE locks every new thread stack whole, the default is 8 MB
+performancereport = {}
 
-# TODO seperate threads for buttons and keys? Keys could get higher sample rate
-    def Buttons():
+def ReportStep(step, ok, detail=''):
+    performancereport[step] = ok
+    writeToLog('Performance mode: %s %s%s' % (step, 'ok' if ok else 'FAILED', ' (%s)' % detail if detail else ''))
+
+def LockedMemory():
+    # MB of locked memory of this process (VmLck), None where /proc doesn't tell
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmLck:'):
+                    return int(line.split()[1]) / 1024.0
+    except (OSError, ValueError):
+        pass
+    return None
+
+processcpus = None         # the CPUs the process could use before StartPerformanceMode pinned the main thread
+
+def UsableCpus(cpus):
+    return set(cpus) & (processcpus or os.sched_getaffinity(0))
+
+def StartPerformanceMode():
+    # Called from the main thread before any other thread starts: they all inherit OTHER_CPUS,
+    # the audio thread is moved to AUDIO_CPUS once it runs
+    global processcpus
+    processcpus = os.sched_getaffinity(0)
+    cpus = UsableCpus(OTHER_CPUS)
+    if len(processcpus) < 2 or not cpus or not UsableCpus(AUDIO_CPUS):
+        ReportStep('pin threads to CPUs %s' % sorted(OTHER_CPUS), False, 'not enough CPUs')
+    else:
         try:
-            # Keys C-E
-            GPIO.setup(26, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(17, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(7, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(8, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(25, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            # Utility switches
-            GPIO.setup(14, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(15, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(23, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(22, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-            GPIO.setup(4, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-
-            dev.setup(0, numato.IN)
-            dev.setup(1, numato.IN)
-            dev.setup(2, numato.IN)
-            dev.setup(3, numato.IN)
-            dev.setup(4, numato.IN)
-            dev.setup(5, numato.IN)
-            dev.setup(6, numato.IN)
-            dev.setup(7, numato.IN)
-
-            global presetIndex, lastbuttontime, globalvolume
-            lastbuttontime = time.time()
-            last_played = []
-            while True:
-                now = time.time()
-                upperKeyMask = dev.readall()
-                # Previous preset
-                if not GPIO.input(15):
-                    lastbuttontime = now
-                    presetIndex -= 1
-                    if presetIndex < 0:
-                        presetIndex = 127
-                    display.print7seg('LdIn')
-                    LoadSamples()
-                    time.sleep(0.2)
-                # Next preset
-                elif not GPIO.input(14):
-                    lastbuttontime = now
-                    presetIndex += 1
-                    if presetIndex > 127:
-                        presetIndex = 0
-                    display.print7seg('LdIn')
-                    LoadSamples()
-                    time.sleep(0.2)
-                # Volume down
-                elif not GPIO.input(22):
-                    lastbuttontime = now
-
-                    display.print7seg('db -')
-                    globalvolume *= 10 ** (-3.0 / 20)
-                    time.sleep(0.5)
-                    display.print7seg("P%03d" % presetIndex)
-                # Volume up
-                elif not GPIO.input(23):
-                    lastbuttontime = now
-                    display.print7seg('db+r')
-                    globalvolume *= 10 ** (3.0 / 20)
-                    time.sleep(0.5)
-                    display.print7seg("P%03d" % presetIndex)
-                # Panic
-                elif not GPIO.input(4):
-                    lastbuttontime = now
-                    display.print7seg('PnIC')
-                    playingnotes.clear()
-                    playingsounds.clear()
-                    time.sleep(0.5)
-                    display.print7seg("P%03d" % presetIndex)
-
-                # Note Ons
-                # C - B1
-                if not GPIO.input(26):
-                    #display.print7seg('C  1')
-                    lastbuttontime = now
-                    PlayNoteCallback(0, True, now)
-                # C# - C1
-                if not GPIO.input(17):
-                    #display.print7seg('C+ 1')
-                    lastbuttontime = now
-                    PlayNoteCallback(1, True, now)
-                # D - B2
-                if not GPIO.input(7):
-                    #display.print7seg('d  1')
-                    lastbuttontime = now
-                    PlayNoteCallback(2, True, now)
-                # D# - C2
-                if not GPIO.input(8):
-                    #display.print7seg('d+ 1')
-                    lastbuttontime = now
-                    PlayNoteCallback(3, True, now)
-                # E - A1
-                if not GPIO.input(25):
-                    #display.print7seg('E  1')
-                    lastbuttontime = now
-                    PlayNoteCallback(4, True, now)
-                # F - A2
-                if not upperKeyMask & 1 > 0:
-                    #display.print7seg('E+ 1')
-                    lastbuttontime = now
-                    PlayNoteCallback(5, True, now)
-                # F# - C3
-                if not upperKeyMask & 2 > 0:
-                    #display.print7seg('E++1')
-                    lastbuttontime = now
-                    PlayNoteCallback(6, True, now)
-                # G - B3
-                if not upperKeyMask & 4 > 0:
-                    #display.print7seg('L  1')
-                    lastbuttontime = now
-                    PlayNoteCallback(7, True, now)
-                # G# - C4
-                if not upperKeyMask & 8 > 0:
-                    #display.print7seg('L+ 1')
-                    lastbuttontime = now
-                    PlayNoteCallback(8, True, now)
-                # A - B4
-                if not upperKeyMask & 16 > 0:
-                    #display.print7seg('0  1')
-                    lastbuttontime = now
-                    PlayNoteCallback(9, True, now)
-                # A# - C5
-                if not upperKeyMask & 32 > 0:
-                    #display.print7seg('0+ 1')
-                    lastbuttontime = now
-                    PlayNoteCallback(10, True, now)
-                # B - B5
-                if not upperKeyMask & 64 > 0:
-                    #display.print7seg('b  1')
-                    lastbuttontime = now
-                    PlayNoteCallback(11, True, now)
-                # C - C6
-                if not upperKeyMask & 128 > 0:
-                    #display.print7seg('C  2')
-                    lastbuttontime = now
-                    PlayNoteCallback(12, True, now)
-
-                # Note Offs
-                # C
-                if GPIO.input(26):
-                    lastbuttontime = now
-                    PlayNoteCallback(0, False, now)
-                # C#
-                if GPIO.input(17):
-                    lastbuttontime = now
-                    PlayNoteCallback(1, False, now)
-                # D
-                if GPIO.input(7):
-                    lastbuttontime = now
-                    PlayNoteCallback(2, False, now)
-                # D#
-                if GPIO.input(8):
-                    lastbuttontime = now
-                    PlayNoteCallback(3, False, now)
-                # E
-                if GPIO.input(25):
-                    lastbuttontime = now
-                    PlayNoteCallback(4, False, now)
-                # F
-                if upperKeyMask & 1 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(5, False, now)
-                # F#
-                if upperKeyMask & 2 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(6, False, now)
-                # G
-                if upperKeyMask & 4 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(7, False, now)
-                # G#
-                if upperKeyMask & 8 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(8, False, now)
-                # A
-                if upperKeyMask & 16 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(9, False, now)
-                # A#
-                if upperKeyMask & 32 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(10, False, now)
-                # B
-                if upperKeyMask & 64 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(11, False, now)
-                # C
-                if upperKeyMask & 128 > 0:
-                    lastbuttontime = now
-                    PlayNoteCallback(12, False, now)
-        except  BaseException as e:
-            writeToLog('Failed in Buttons(): ' + str(e))
+            os.sched_setaffinity(0, cpus)
+            ReportStep('pin threads to CPUs %s' % sorted(cpus), True)
+        except OSError as e:
+            ReportStep('pin threads to CPUs %s' % sorted(cpus), False, e.strerror)
+
+    threading.stack_size(THREAD_STACK_SIZE)     # for the buttons, MIDI, watcher, recorder and loader threads
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+        locked = LockedMemory()
+        ReportStep('mlockall', True, '%d kB thread stacks%s' % (THREAD_STACK_SIZE // 1024, ', %.1f MB locked' % locked if locked is not None else ''))
+    else:
+        ReportStep('mlockall', False, os.strerror(ctypes.get_errno()))
+
+def SetupAudioThread():
+    for i in range(100):
+        if audiothreadid is not None:
+            break
+        time.sleep(0.01)
+    else:
+        ReportStep('find audio thread', False, 'no audio callback yet')
+        return
+    try:
+        os.sched_setscheduler(audiothreadid, os.SCHED_FIFO, os.sched_param(AUDIO_RT_PRIORITY))
+        ReportStep('SCHED_FIFO %d for audio thread' % AUDIO_RT_PRIORITY, True)
+    except OSError as e:
+        ReportStep('SCHED_FIFO %d for audio thread' % AUDIO_RT_PRIORITY, False, e.strerror)
+    cpus = UsableCpus(AUDIO_CPUS)
+    if not cpus:
+        ReportStep('pin audio thread to CPUs %s' % sorted(AUDIO_CPUS), False, 'CPUs not available')
+        return
+    try:
+        os.sched_setaffinity(audiothreadid, cpus)
+        ReportStep('pin audio thread to CPUs %s' % sorted(cpus), True)
+    except OSError as e:
+        ReportStep('pin audio thread to CPUs %s' % sorted(cpus), False, e.strerror)
+
+def Prefault(sounds, index):
+    # Touch every page of the sample data so the first strike of a pedal doesn't page-fault
+    pagesize = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    for sound in sounds:
+        sound.data[::pagesize // sound.data.itemsize].sum()
+        total += sound.data.nbytes
+    locked = LockedMemory()
+    ReportStep('prefault preset %d, %.1f MB' % (index, total / 1e6), True, '%.1f MB locked' % locked if locked is not None else '')
+
+#########################################
+# BUTTONS THREAD (RASPBERRY PI GPIO)
+#
+#########################################
+
+GPIO = None
+numato = None
+dev = None
+lastbuttontime = 0
+ButtonsReady = threading.Event()
+
+def StartButtons():
+    global GPIO, numato, dev
+    try:
+        with BootStage('buttons'):
+            if USE_SIMULATED_HARDWARE:
+                from simhw import GPIO, numato
+            else:
+                import RPi.GPIO as GPIO
+                import numato_gpio as numato
+            GPIO.setmode(GPIO.BCM)
+
+            writeToLog('Attempting to open Numato GPIO')
+            numato_serial_fd = '/dev/ttyACM0'
+            dev = numato.NumatoUsbGpio(numato_serial_fd)
+            writeToLog('Successfully opened Numato GPIO')
+    except BaseException as e:
+        writeToLog('Failed in StartButtons(): ' + str(e))
+        ButtonsReady.set()      # boot goes on without the pedals
+        return
+
     ButtonsThread = threading.Thread(target=Buttons)
     ButtonsThread.daemon = True
     ButtonsThread.start()
 
+# TODO seperate threads for buttons and keys? Keys could get higher sample rate
+def Buttons():
+    try:
+        # Keys C-E
+        GPIO.setup(26, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(17, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(7, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(8, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(25, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        # Utility switches
+        GPIO.setup(14, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(15, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(23, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(22, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(4, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+        dev.setup(0, numato.IN)
+        dev.setup(1, numato.IN)
+        dev.setup(2, numato.IN)
+        dev.setup(3, numato.IN)
+        dev.setup(4, numato.IN)
+        dev.setup(5, numato.IN)
+        dev.setup(6, numato.IN)
+        dev.setup(7, numato.IN)
+
+        global presetIndex, lastbuttontime, globalvolume
+        lastbuttontime = time.time()
+        last_played = []
+        ButtonsReady.set()
+        while True:
+            now = time.time()
+            upperKeyMask = dev.readall()
+            # Previous preset
+            if not GPIO.input(15):
+                lastbuttontime = now
+                presetIndex -= 1
+                if presetIndex < 0:
+                    presetIndex = 127
+                display.print7seg('LdIn')
+                LoadSamples()
+                time.sleep(0.2)
+            # Next preset
+            elif not GPIO.input(14):
+                lastbuttontime = now
+                presetIndex += 1
+                if presetIndex > 127:
+                    presetIndex = 0
+                display.print7seg('LdIn')
+                LoadSamples()
+                time.sleep(0.2)
+            # Volume down
+            elif not GPIO.input(22):
+                lastbuttontime = now
+
+                display.print7seg('db -')
+                globalvolume *= 10 ** (-3.0 / 20)
+                time.sleep(0.5)
+                display.print7seg("P%03d" % presetIndex)
+            # Volume up
+            elif not GPIO.input(23):
+                lastbuttontime = now
+                display.print7seg('db+r')
+                globalvolume *= 10 ** (3.0 / 20)
+                time.sleep(0.5)
+                display.print7seg("P%03d" % presetIndex)
+            # Panic, held for RECORD_HOLD_SECS: start or stop recording
+            elif not GPIO.input(4):
+                lastbuttontime = now
+                display.print7seg('PnIC')
+                Panic()
+                time.sleep(0.5)
+                while not GPIO.input(4) and time.time() - now < RECORD_HOLD_SECS:
+                    time.sleep(0.05)
+                if not GPIO.input(4):
+                    ToggleRecording()
+                    while not GPIO.input(4):
+                        time.sleep(0.05)
+                display.print7seg("P%03d" % presetIndex)
+
+            # Note Ons
+            # C - B1
+            if not GPIO.input(26):
+                #display.print7seg('C  1')
+                lastbuttontime = now
+                PlayNoteCallback(0, True, now)
+            # C# - C1
+            if not GPIO.input(17):
+                #display.print7seg('C+ 1')
+                lastbuttontime = now
+                PlayNoteCallback(1, True, now)
+            # D - B2
+            if not GPIO.input(7):
+                #display.print7seg('d  1')
+                lastbuttontime = now
+                PlayNoteCallback(2, True, now)
+            # D# - C2
+            if not GPIO.input(8):
+                #display.print7seg('d+ 1')
+                lastbuttontime = now
+                PlayNoteCallback(3, True, now)
+            # E - A1
+            if not GPIO.input(25):
+                #display.print7seg('E  1')
+                lastbuttontime = now
+                PlayNoteCallback(4, True, now)
+            # F - A2
+            if not upperKeyMask & 1 > 0:
+                #display.print7seg('E+ 1')
+                lastbuttontime = now
+                PlayNoteCallback(5, True, now)
+            # F# - C3
+            if not upperKeyMask & 2 > 0:
+                #display.print7seg('E++1')
+                lastbuttontime = now
+                PlayNoteCallback(6, True, now)
+            # G - B3
+            if not upperKeyMask & 4 > 0:
+                #display.print7seg('L  1')
+                lastbuttontime = now
+                PlayNoteCallback(7, True, now)
+            # G# - C4
+            if not upperKeyMask & 8 > 0:
+                #display.print7seg('L+ 1')
+                lastbuttontime = now
+                PlayNoteCallback(8, True, now)
+            # A - B4
+            if not upperKeyMask & 16 > 0:
+                #display.print7seg('0  1')
+                lastbuttontime = now
+                PlayNoteCallback(9, True, now)
+            # A# - C5
+            if not upperKeyMask & 32 > 0:
+                #display.print7seg('0+ 1')
+                lastbuttontime = now
+                PlayNoteCallback(10, True, now)
+            # B - B5
+            if not upperKeyMask & 64 > 0:
+                #display.print7seg('b  1')
+                lastbuttontime = now
+                PlayNoteCallback(11, True, now)
+            # C - C6
+            if not upperKeyMask & 128 > 0:
+                #display.print7seg('C  2')
+                lastbuttontime = now
+                PlayNoteCallback(12, True, now)
+
+            # Note Offs
+            # C
+            if GPIO.input(26):
+                lastbuttontime = now
+                PlayNoteCallback(0, False, now)
+            # C#
+            if GPIO.input(17):
+                lastbuttontime = now
+                PlayNoteCallback(1, False, now)
+            # D
+            if GPIO.input(7):
+                lastbuttontime = now
+                PlayNoteCallback(2, False, now)
+            # D#
+            if GPIO.input(8):
+                lastbuttontime = now
+                PlayNoteCallback(3, False, now)
+            # E
+            if GPIO.input(25):
+                lastbuttontime = now
+                PlayNoteCallback(4, False, now)
+            # F
+            if upperKeyMask & 1 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(5, False, now)
+            # F#
+            if upperKeyMask & 2 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(6, False, now)
+            # G
+            if upperKeyMask & 4 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(7, False, now)
+            # G#
+            if upperKeyMask & 8 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(8, False, now)
+            # A
+            if upperKeyMask & 16 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(9, False, now)
+            # A#
+            if upperKeyMask & 32 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(10, False, now)
+            # B
+            if upperKeyMask & 64 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(11, False, now)
+            # C
+            if upperKeyMask & 128 > 0:
+                lastbuttontime = now
+                PlayNoteCallback(12, False, now)
+    except  BaseException as e:
+        writeToLog('Failed in Buttons(): ' + str(e))
+    finally:
+        ButtonsReady.set()
+
 
 #########################################
-# LOAD FIRST SOUNDBANK
+# MIDI IN
 #
 #########################################
 
+def MidiReader(read):
+    # read() blocks until at least one byte is available and returns everything that is waiting
+    parser = MidiParser()
+    try:
+        while True:
+            data = read()
+            event_time = time.time()
+            for message in parser.feed(data):
+                MidiCallback(message, event_time)
+    except BaseException as e:
+        writeToLog('Failed in MidiReader(): ' + str(e))
 
-LoadSamples()
+def StartMidiReader(read):
+    MidiThread = threading.Thread(target=MidiReader, args=(read,))
+    MidiThread.daemon = True
+    MidiThread.start()
 
-def onShutdown():
-    display.print7seg('1n1+')
+def StartSerialMidi(device=SERIALPORT_MIDI_DEVICE):
+    try:
+        with BootStage('serial midi'):
+            import serial
+            ser = serial.Serial(device, baudrate=SERIALPORT_MIDI_BAUDRATE)
+            writeToLog('Opened serial MIDI %s' % device)
+    except BaseException as e:
+        writeToLog('Failed in StartSerialMidi(): ' + str(e))
+        return
+    StartMidiReader(lambda: ser.read(ser.in_waiting or 1))
+
+def StartRawMidi(device=RAWMIDI_DEVICE):
+    try:
+        with BootStage('rawmidi'):
+            fd = os.open(device, os.O_RDONLY)
+            writeToLog('Opened rawmidi %s' % device)
+    except BaseException as e:
+        writeToLog('Failed in StartRawMidi(): ' + str(e))
+        return
+    StartMidiReader(lambda: os.read(fd, 256))
 
-import atexit
 
-atexit.register(onShutdown)
+#########################################
+# BOOT
+#
+#########################################
+
+BUTTONS_TIMEOUT_SECS = 10
+
+def WaitUntilPlayable():
+    # Logs power-on-to-playable: audio is open, preset 0 is loaded and the pedals are read
+    with BootStage('playable'):
+        PresetLoaded.wait()
+        if USE_BUTTONS and not ButtonsReady.wait(BUTTONS_TIMEOUT_SECS):
+            writeToLog('Boot: pedals not ready after %d s, going on without them' % BUTTONS_TIMEOUT_SECS)
+    uptime = Uptime()
+    if uptime is not None:
+        writeToLog('Boot: playable %.2f s after power-on' % uptime)
+
+def onShutdown():
+    recorder.stop()
+    display.print7seg('1n1+')
 
-while True:
-    time.sleep(0.5)
+def Boot():
+    from datetime import datetime
+    import atexit
+
+    writeToLog("Starting samplerbox.py at " + datetime.now().strftime("%d/%m/%Y %H:%M:%S"))
+    if PERFORMANCE_MODE:
+        StartPerformanceMode()
+
+    # Secondary devices come up in parallel, audio and the first preset don't wait for them
+    if USE_I2C_7SEGMENTDISPLAY:
+        threading.Thread(target=StartDisplay, daemon=True).start()
+    if USE_BUTTONS:
+        threading.Thread(target=StartButtons, daemon=True).start()
+    if USE_SERIALPORT_MIDI:
+        threading.Thread(target=StartSerialMidi, daemon=True).start()
+    if USE_RAWMIDI:
+        threading.Thread(target=StartRawMidi, daemon=True).start()
+
+    OpenAudio()
+    with BootStage('library'):
+        LoadLibrary()
+        ScanLibrary()
+    threading.Thread(target=WatchLibrary, daemon=True).start()
+    LoadSamples()
+    if PERFORMANCE_MODE:
+        SetupAudioThread()
+
+    atexit.register(onShutdown)
+    WaitUntilPlayable()
+
+def Housekeeping():
+    # Everything the audio thread must not do itself (logging, file I/O) happens here
+    lastreport = time.time()
+    overflows = 0
+    while True:
+        time.sleep(0.5)
+        governor.LogEvents()
+        if recorder.overflows != overflows:
+            overflows = recorder.overflows
+            writeToLog('Recorder: %d blocks dropped so far, the writer is behind' % overflows)
+        if time.time() - lastreport > 60:
+            lastreport = time.time()
+            report = LatencyReport()
+            if report:
+                writeToLog(report)
+
+if __name__ == '__main__':
+    Boot()
+    Housekeeping()
@@ -14,65 +14,74 @@ import cython
 import numpy
 cimport numpy
 
-def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndarray FADEOUT, int FADEOUTLENGTH, numpy.ndarray SPEED):
-    cdef int i, ii, k, l, N, length, looppos, fadeoutpos
-    cdef float speed, newsz, pos, j
+def mixaudiobuffers(list playingsounds, list rmlist, int frame_count, numpy.ndarray FADEOUT, int FADEOUTLENGTH, bint interpolate=True):
+    cdef int i, k, length, looppos, fadeoutpos, fadeoutstep, f
+    cdef double j, speed, targetspeed, dspeed
+    cdef float gain, g
+    cdef bint isfadeout, stereo
     cdef numpy.ndarray b = numpy.zeros(2 * frame_count, numpy.float32)      # output buffer
     cdef float* bb = <float *> (b.data)                                     # and its pointer
+    cdef numpy.ndarray m = numpy.zeros(frame_count, numpy.float32)          # mono voices, copied to both channels at the end
+    cdef float* mm = <float *> (m.data)
     cdef numpy.ndarray z
     cdef short* zz
     cdef float* fadeout = <float *> (FADEOUT.data)
 
     for snd in playingsounds:
-        pos = snd.pos
+        j = snd.pos
+        speed = snd.speed
+        targetspeed = snd.targetspeed
+        dspeed = (targetspeed - speed) / frame_count                        # a new speed (pitch bend) is reached over one block
         fadeoutpos = snd.fadeoutpos
+        fadeoutstep = snd.fadeoutstep
+        isfadeout = snd.isfadeout
+        gain = snd.gain
+        stereo = snd.sound.numchan == 2
         looppos = snd.sound.loop
         length = snd.sound.nframes
-        speed = SPEED[snd.note - snd.sound.midinote]
-        newsz = frame_count * speed
         z = snd.sound.data
         zz = <short *> (z.data)
 
-        N = frame_count
-
-        if (pos + frame_count * speed > length - 4) and (looppos == -1):
+        if isfadeout and fadeoutpos > FADEOUTLENGTH:
             rmlist.append(snd)
-            N = <int> ((length - 4 - pos) / speed)
-
-        if snd.isfadeout:
-            if fadeoutpos > FADEOUTLENGTH: 
-                rmlist.append(snd)   
-            ii = 0   
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
-                k = <int> j
-                if k > length - 2:
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j       
-                bb[2 * i] += (zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])) * fadeout[fadeoutpos + i]                   # linear interpolation
-                bb[2 * i + 1] += (zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])) * fadeout[fadeoutpos + i]        
-            snd.fadeoutpos += i
-
-        else:
-            ii = 0            
-            for i in range(N):
-                j = pos + ii * speed
-                ii += 1                  
-                k = <int> j
-                if k > length - 2:
-                    pos = looppos + 1
-                    snd.pos = pos
-                    ii = 0
-                    j = pos + ii * speed   
-                    k = <int> j  
-                bb[2 * i] += zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])                                               # linear interpolation
-                bb[2 * i + 1] += zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])
-
-        snd.pos += ii * speed
+
+        g = gain
+        i = 0
+        for i in range(frame_count):
+            k = <int> j
+            if k > length - 4 and looppos == -1:
+                rmlist.append(snd)
+                break
+            if k > length - 2:
+                j = looppos + 1
+                k = looppos + 1
+            if isfadeout:
+                f = fadeoutpos + i * fadeoutstep                                                                       # fadeoutstep > 1 for short crossfades
+                if f > FADEOUTLENGTH:
+                    f = FADEOUTLENGTH
+                g = fadeout[f] * gain
+            if not stereo:
+                if interpolate:
+                    mm[i] += (zz[k] + (j - k) * (zz[k + 1] - zz[k])) * g                                          # linear interpolation
+                else:
+                    mm[i] += zz[k] * g                                                                            # drop-sample, cheaper
+            elif interpolate:
+                bb[2 * i] += (zz[2 * k] + (j - k) * (zz[2 * k + 2] - zz[2 * k])) * g
+                bb[2 * i + 1] += (zz[2 * k + 1] + (j - k) * (zz[2 * k + 3] - zz[2 * k + 1])) * g
+            else:
+                bb[2 * i] += zz[2 * k] * g
+                bb[2 * i + 1] += zz[2 * k + 1] * g
+            j += speed
+            speed += dspeed
+
+        if isfadeout:
+            snd.fadeoutpos += i * fadeoutstep
+        snd.pos = j
+        snd.speed = targetspeed
+
+    for i in range(frame_count):
+        bb[2 * i] += mm[i]
+        bb[2 * i + 1] += mm[i]
 
     return b
 
@@ -83,4 +92,91 @@ def binary24_to_int16(char *data, int length):
     for i in range(length):
         b[2*i] = data[3*i+1]
         b[2*i+1] = data[3*i+2]
-    return res
\ No newline at end of file
+    return res
+
+def mixaudiobuffers_fixed(list playingsounds, list rmlist, int frame_count, numpy.ndarray FADEOUT_Q15, int FADEOUTLENGTH, bint interpolate=True, int volume=32768):
+    # Integer version of mixaudiobuffers for CPUs without a fast FPU (Pi Zero, Pi 1):
+    # 16.16 fixed-point phase (16.32 speed while it glides), Q15 gain and envelope, int32 accumulators, saturated int16 output
+    cdef int i, k, n, length, looppos, fadeoutpos, fadeoutstep, f, s0, s1, g, gain, frac15
+    cdef unsigned int frac
+    cdef long long v, inc, targetinc, dinc
+    cdef bint isfadeout, stereo
+    cdef numpy.ndarray acc = numpy.zeros(2 * frame_count, numpy.int32)     # accumulator
+    cdef int* aa = <int *> (acc.data)
+    cdef numpy.ndarray monoacc = numpy.zeros(frame_count, numpy.int32)     # mono voices, added to both channels at the end
+    cdef int* ma = <int *> (monoacc.data)
+    cdef numpy.ndarray b = numpy.empty(2 * frame_count, numpy.int16)        # output buffer
+    cdef short* bb = <short *> (b.data)
+    cdef numpy.ndarray z
+    cdef short* zz
+    cdef short* fadeout = <short *> (FADEOUT_Q15.data)
+
+    for snd in playingsounds:
+        k = <int> snd.pos
+        frac = <unsigned int> ((snd.pos - k) * 65536)
+        inc = (<long long> (snd.speed * 65536 + 0.5)) << 16
+        targetspeed = snd.targetspeed
+        targetinc = (<long long> (targetspeed * 65536 + 0.5)) << 16
+        dinc = (targetinc - inc) // frame_count                             # a new speed (pitch bend) is reached over one block
+        fadeoutpos = snd.fadeoutpos
+        fadeoutstep = snd.fadeoutstep
+        isfadeout = snd.isfadeout
+        gain = <int> (snd.gain * 32768)
+        stereo = snd.sound.numchan == 2
+        looppos = snd.sound.loop
+        length = snd.sound.nframes
+        z = snd.sound.data
+        zz = <short *> (z.data)
+
+        if isfadeout and fadeoutpos > FADEOUTLENGTH:
+            rmlist.append(snd)
+
+        g = gain
+        i = 0
+        for i in range(frame_count):
+            if k > length - 4 and looppos == -1:
+                rmlist.append(snd)
+                break
+            if k > length - 2:
+                k = looppos + 1
+                frac = 0
+            if isfadeout:
+                f = fadeoutpos + i * fadeoutstep
+                if f > FADEOUTLENGTH:
+                    f = FADEOUTLENGTH
+                g = (fadeout[f] * (<long long> gain)) >> 15
+            frac15 = frac >> 1
+            if not stereo:
+                if interpolate:
+                    s0 = zz[k] + (((zz[k + 1] - zz[k]) * frac15) >> 15)                                          # linear interpolation
+                else:
+                    s0 = zz[k]                                                                                 # drop-sample, cheaper
+                ma[i] += <int> ((s0 * (<long long> g)) >> 15)
+            else:
+                if interpolate:
+                    s0 = zz[2 * k] + (((zz[2 * k + 2] - zz[2 * k]) * frac15) >> 15)
+                    s1 = zz[2 * k + 1] + (((zz[2 * k + 3] - zz[2 * k + 1]) * frac15) >> 15)
+                else:
+                    s0 = zz[2 * k]
+                    s1 = zz[2 * k + 1]
+                aa[2 * i] += <int> ((s0 * (<long long> g)) >> 15)
+                aa[2 * i + 1] += <int> ((s1 * (<long long> g)) >> 15)
+            frac += <unsigned int> (inc >> 16)
+            k += frac >> 16
+            frac &= 0xFFFF
+            inc += dinc
+
+        if isfadeout:
+            snd.fadeoutpos += i * fadeoutstep
+        snd.pos = k + frac / 65536.0
+        snd.speed = targetspeed
+
+    for n in range(2 * frame_count):
+        v = ((aa[n] + (<long long> ma[n >> 1])) * volume) >> 15
+        if v > 32767:
+            v = 32767
+        elif v < -32768:
+            v = -32768
+        bb[n] = <short> v
+
+    return b
@@ -0,0 +1,198 @@
+#  Simulated hardware for running samplerbox.py on a Linux workstation
+#  (set SAMPLERBOX_SIMULATE=1, or USE_SIMULATED_HARDWARE = True).
+#
+#  GPIO         stands in for RPi.GPIO, pins are driven by Press() / Release() or RunScript()
+#  numato       stands in for numato_gpio, the 8 upper pedals
+#  NullDisplay  stands in for the TM1637, remembers what it was asked to show
+#  OutputStream stands in for sounddevice.OutputStream, calls the audio callback on a virtual
+#               clock and measures the time from each pedal edge to the first non-zero sample
+
+import threading
+import time
+import numpy
+
+NUMATO_READ_SECS = 0.001        # round trip of a readall() over the Numato's USB serial port
+
+# Same wiring as Buttons() in samplerbox.py
+PEDALS = [('gpio', 26), ('gpio', 17), ('gpio', 7), ('gpio', 8), ('gpio', 25)] + [('numato', port) for port in range(8)]
+SWITCHES = {'next': 14, 'previous': 15, 'volume+': 23, 'volume-': 22, 'panic': 4}
+
+pendingedges = []               # press times not yet heard at the output
+edgelatencies = []              # seconds from pedal edge to the first non-zero output sample
+edgelock = threading.Lock()
+
+
+class ScriptedGPIO:
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    LOW = 0
+    HIGH = 1
+
+    def __init__(self):
+        self.levels = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        if pin not in self.levels:
+            self.levels[pin] = self.HIGH if pull_up_down != self.PUD_DOWN else self.LOW
+
+    def input(self, pin):
+        return self.levels.get(pin, self.HIGH)
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def cleanup(self):
+        self.levels.clear()
+
+
+class FakeNumato:
+    IN = 1
+    OUT = 0
+
+    def __init__(self):
+        self.mask = 0xFF        # inputs are pulled up, a pressed pedal reads low
+
+    def NumatoUsbGpio(self, device):
+        return self
+
+    def setup(self, port, direction):
+        pass
+
+    def readall(self):
+        time.sleep(NUMATO_READ_SECS)
+        return self.mask
+
+    def setport(self, port, level):
+        if level:
+            self.mask |= 1 << port
+        else:
+            self.mask &= ~(1 << port)
+
+
+GPIO = ScriptedGPIO()
+numato = FakeNumato()
+
+
+def SetPin(target, level):
+    kind, pin = target
+    if not level:
+        with edgelock:
+            pendingedges.append(time.time())
+    if kind == 'gpio':
+        GPIO.output(pin, level)
+    else:
+        numato.setport(pin, level)
+
+def Press(pedal):
+    SetPin(PEDALS[pedal], 0)
+
+def Release(pedal):
+    SetPin(PEDALS[pedal], 1)
+
+def Switch(name, seconds=0.1):
+    GPIO.output(SWITCHES[name], 0)
+    time.sleep(seconds)
+    GPIO.output(SWITCHES[name], 1)
+
+def RunScript(script):
+    # script is a list of (seconds from start, 'press' | 'release', pedal)
+    start = time.time()
+    for at, action, pedal in sorted(script):
+        time.sleep(max(0, start + at - time.time()))
+        if action == 'press':
+            Press(pedal)
+        else:
+            Release(pedal)
+
+
+class NullDisplay:
+
+    def __init__(self, *args, **kwargs):
+        self.message = None
+
+    def Clear(self):
+        self.message = None
+
+    def SetBrightness(self, percent):
+        pass
+
+    def print7seg(self, message):
+        self.message = message
+
+
+class CallbackFlags:
+
+    def __init__(self, underflow):
+        self.output_underflow = underflow
+        self.output_overflow = False
+        self.priming_output = False
+
+
+class TimeInfo:
+
+    def __init__(self, currentTime, outputBufferDacTime):
+        self.currentTime = currentTime
+        self.outputBufferDacTime = outputBufferDacTime
+
+
+class OutputStream:
+    # Calls the callback every blocksize / samplerate seconds of wall time, each block is
+    # heard one block after it is requested, like a double-buffered sound card
+
+    def __init__(self, device=None, blocksize=512, samplerate=44100, channels=2, dtype='int16', callback=None):
+        self.blocksize = blocksize
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = dtype
+        self.callback = callback
+        self.active = False
+        self.underflows = 0
+        self.thread = None
+
+    def start(self):
+        self.active = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.active = False
+
+    def close(self):
+        self.stop()
+
+    def run(self):
+        outdata = numpy.zeros((self.blocksize, self.channels), self.dtype)
+        blocktime = self.blocksize / float(self.samplerate)
+        nextblock = time.time()
+        underflow = False
+        while self.active:
+            time.sleep(max(0, nextblock - time.time()))
+            dactime = nextblock + blocktime
+            self.callback(outdata, self.blocksize, TimeInfo(nextblock, dactime), CallbackFlags(underflow))
+            underflow = time.time() > dactime
+            if underflow:
+                self.underflows += 1
+                nextblock = time.time()
+            self.measure(outdata, dactime)
+            nextblock += blocktime
+
+    def measure(self, outdata, dactime):
+        if not pendingedges:
+            return
+        nonzero = numpy.flatnonzero(outdata.any(axis=1))
+        if len(nonzero):
+            heard = dactime + nonzero[0] / float(self.samplerate)
+            with edgelock:
+                edgelatencies.extend(heard - edge for edge in pendingedges if edge < heard)
+                pendingedges[:] = [edge for edge in pendingedges if edge >= heard]
@@ -0,0 +1,51 @@
+#  Runs samplerbox.py on simulated hardware (see simhw.py) and reports the distribution of the
+#  latency from a pedal's pin edge to the first non-zero output sample. No Raspberry Pi needed.
+#
+#  python3 simlatency.py [number of presses]
+
+import os
+import sys
+import tempfile
+import time
+import numpy
+import simhw
+import samplerbox
+from benchmark import WriteWav
+
+presses = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+
+directory = tempfile.mkdtemp()
+preset = os.path.join(directory, '0 Simulated')
+os.mkdir(preset)
+for note in range(13):
+    WriteWav(os.path.join(preset, '%d.wav' % note), 13230, freq=65.41 * 2 ** (note / 12.0))
+
+samplerbox.USE_SIMULATED_HARDWARE = True
+samplerbox.SAMPLES_DIR = directory
+samplerbox.CACHE_DIR = os.path.join(directory, 'cache')
+samplerbox.LOG_FILE = os.path.join(directory, 'sbox.log')
+samplerbox.USE_SERIALPORT_MIDI = False
+samplerbox.USE_RAWMIDI = False
+samplerbox.Boot()
+
+for name, start, duration in samplerbox.boottimes:
+    print('boot %-10s %7.1f ms' % (name, duration * 1000))
+
+for i in range(presses):
+    pedal = i % len(simhw.PEDALS)
+    simhw.Press(pedal)
+    time.sleep(0.2)
+    simhw.Release(pedal)
+    time.sleep(0.3)         # let the 0.3 s sample end, so the next edge starts from silence
+
+latencies = numpy.array(simhw.edgelatencies) * 1000
+if not len(latencies):
+    print('No pedal press was heard, see ' + samplerbox.LOG_FILE)
+    sys.exit(1)
+print('%d of %d presses heard, %d underflows' % (len(latencies), presses, samplerbox.sd.underflows))
+print('pin edge to first sample: min %.1f  median %.1f  p90 %.1f  p99 %.1f  max %.1f ms' % (
+    latencies.min(), numpy.median(latencies), numpy.percentile(latencies, 90), numpy.percentile(latencies, 99), latencies.max()))
+counts, edges = numpy.histogram(latencies, bins=10)
+for count, low, high in zip(counts, edges[:-1], edges[1:]):
+    print('%6.1f - %6.1f ms %s' % (low, high, '#' * count))
+print(samplerbox.LatencyReport())